@@ -0,0 +1,254 @@
+# coding=utf-8
+# micro-benchmarks for hot paths, run against a small fixture database generated from
+# data/verses_free.txt.bz2 (plus synthetic annotated versions in place of KJAV and others).
+#
+# usage: python bench.py [-k substring] [--save baseline.json] [--compare baseline.json]
+import os
+import sys
+import bz2
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# fixture books (Korean abbreviations as in verses_*.txt.bz2)
+FIXTURE_BOOKS = (u'창', u'시', u'요', u'계')
+# synthetic versions (by their abbreviations) and salts for `annotate`
+FIXTURE_VERSIONS = ((u'흠정역', ''), (u'개역', 'krv'), (u'개정', 'nkrv'), (u'현대인', 'klb'))
+FIXTURE_DAILY = {
+    '01-01': ['Gen', 1, 3],
+    '01-02': ['Gen', 4, 6],
+    '02-01': ['Ps', 119, 119],
+    '02-02': ['Ps', 1, 1, 3, 8],
+    '03-01': ['John', 1, 3],
+    '12-31': ['Rev', 20, 22],
+}
+
+# deterministically turns KJV text into a Hangul text with KJAV-style markups
+def annotate(t, salt=''):
+    words = []
+    for w in t.replace(u'<i>', u' ').replace(u'</i>', u' ').split():
+        h = int(hashlib.md5(salt + w.strip(u'.,;:?!()').lower().encode('utf-8')).hexdigest(), 16)
+        k = u''.join(unichr(0xac00 + (h >> (8*i)) % 11172) for i in xrange(1 + h % 3))
+        r = (h >> 64) % 100
+        if r < 5: k = u'[%s]' % k
+        elif r < 7: k = u'{%s}' % k
+        elif r < 12: k = u'<i>%s</i>' % k
+        elif r < 16: k += u'(神)'
+        elif r < 17: k += u'(上帝)(天)'
+        words.append(k)
+    return u' '.join(words)
+
+def make_fixture(path):
+    data = os.path.join(path, 'data')
+    os.makedirs(data)
+    for name in ('versions.json', 'books.csv'):
+        shutil.copy(os.path.join(ROOT, 'data', name), data)
+    with open(os.path.join(data, 'daily.json'), 'wb') as f:
+        json.dump(FIXTURE_DAILY, f)
+
+    out = bz2.BZ2File(os.path.join(data, 'verses_fixture.txt.bz2'), 'wb')
+    for line in bz2.BZ2File(os.path.join(ROOT, 'data', 'verses_free.txt.bz2')):
+        bv, b, c, v, t = line.rstrip('\r\n').decode('utf-8').split('\t')
+        if b not in FIXTURE_BOOKS: continue
+        out.write(line)
+        for version, salt in FIXTURE_VERSIONS:
+            out.write(u'\t'.join((version, b, c, v, annotate(t, salt))).encode('utf-8') + '\n')
+    out.close()
+
+    # populate.py is looked up from ROOT, as a relative entry in sys.path breaks after chdir
+    if ROOT not in sys.path: sys.path.insert(0, ROOT)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        import populate
+        populate.main('db/bible.db', 1)
+    finally:
+        os.chdir(cwd)
+
+# runs `func` in batches taking at least `min_time` seconds each, and returns
+# the list of seconds per call for each of `repeat` batches
+def measure(func, repeat, min_time):
+    loops = 1
+    while True:
+        t = time.time()
+        for _ in xrange(loops): func()
+        elapsed = time.time() - t
+        if elapsed >= min_time: break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-6) * 1.2))
+    timings = [elapsed / loops]
+    for _ in xrange(repeat - 1):
+        t = time.time()
+        for _ in xrange(loops): func()
+        timings.append((time.time() - t) / loops)
+    return timings
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n//2] if n % 2 else (values[n//2-1] + values[n//2]) / 2.0
+
+def summarize(timings):
+    med = median(timings)
+    return {'median': med, 'mad': median([abs(t - med) for t in timings]), 'min': min(timings)}
+
+# returns a list of (name, function) pairs. this should be called within a request context.
+def benchmarks():
+    import bible
+    import populate
+    from flask import g
+
+    mappings = bible.mappings
+    benches = []
+    def bench(name):
+        def register(func):
+            benches.append((name, func))
+            return func
+        return register
+
+    with bible.database() as db:
+        kjv = db.execute('select ordinal, expand(version, "text") as "text", meta, '
+                         'expand(version, coalesce(html, "text")) as html from data '
+                         'where version=? order by ordinal limit 200;', ('kjv',)).fetchall()
+        kjav = db.execute('select ordinal, expand(version, "text") as "text", meta from data '
+                          'where version=? and meta is not null order by ordinal limit 200;',
+                          ('kjav',)).fetchall()
+    rawlines = []
+    for line in bz2.BZ2File(os.path.join(ROOT, 'data', 'verses_free.txt.bz2')):
+        rawlines.append(line.rstrip('\r\n').decode('utf-8').split('\t')[4])
+        if len(rawlines) >= 200: break
+    annotated = map(annotate, rawlines)
+
+    @bench('htmltext/plain')
+    def _():
+        for row in kjv: bible.filter_htmltext(row['text'], row['meta'], [], row['html'])
+
+    @bench('htmltext/annotated')
+    def _():
+        for row in kjav: bible.filter_htmltext(row['text'], row['meta'])
+
+    @bench('htmltext/highlighted')
+    def _():
+        for row in kjv:
+            bible.filter_htmltext(row['text'], row['meta'], [u'the', u'God', u'and'], row['html'])
+
+    client = bible.app.test_client()
+    @bench('search/parse')
+    def _():
+        # these are all redirected before any query is made
+        client.get('/search?q=John+3:16')
+        client.get('/search?q=%EC%9A%94%ED%95%9C+%EA%B3%84%EC%8B%9C%EB%A1%9D+3:1-4:2')
+        client.get('/search?q=1+John+2+v:KJV')
+
+    @bench('search/candidates')
+    def _():
+        with bible.database() as db:
+            for keywords in ([u'righteous'], [u'love', u'brother'], [u'faith', u'works']):
+                bible.find_candidate_ordinals(db, 'kjv', keywords)
+
+    @bench('aliases')
+    def _():
+        for alias in (u'Gen', u'창세기', u'1 John', u'요한 계시록', u'Psalms'):
+            mappings.find_book_and_lang_by_alias(alias)
+        for alias in (u'KJV', u'흠정', u'개역개정', u'nrsv'):
+            mappings.find_version_by_alias(alias)
+
+    @bench('triple')
+    def _():
+        for chapter in xrange(1, 51):
+            bible.triple(0, chapter, 1)
+            bible.triple(0, chapter, '$')
+
+    @bench('daily')
+    def _():
+        for index in xrange(len(mappings.dailyranges)):
+            bible.Daily(bible.mappings, index)
+
+    @bench('daily/shared')
+    def _():
+        for index in xrange(len(mappings.dailyranges)):
+            mappings.get_daily(index).next
+
+    start = bible.triple(18, 119, 1).ordinal
+    end = bible.triple(18, 119, '$').ordinal
+    # the cost should grow linearly with the number of versions
+    versions = [mappings.versions[v] for v in ('kjv', 'kjav', 'krv', 'nkrv', 'klb')]
+    # `verse_cache` (warmed by the first call), verse stores and SQLite respectively
+    for suffix, stores, cached in (('', mappings.verse_stores, True),
+                                   ('/store', mappings.verse_stores, False),
+                                   ('/sql', {}, False)):
+        for nversions in xrange(1, len(versions) + 1):
+            @bench('verses_query/%dv%s' % (nversions, suffix))
+            def _(stores=stores, cached=cached, nversions=nversions):
+                saved = mappings.verse_stores
+                mappings.verse_stores = stores
+                if not cached: bible.verse_cache.clear()
+                g.versions = versions[:nversions]
+                try:
+                    with bible.database() as db:
+                        bible.execute_verses_query(db, ranges=[(start, end)], count=None)
+                finally:
+                    mappings.verse_stores = saved
+
+    @bench('verse_store/slice')
+    def _():
+        mappings.verse_stores['kjv'].slice(start, end)
+
+    @bench('populate/parse_text')
+    def _():
+        for t in rawlines: populate.parse_text(u'kjv', t)
+        for t in annotated: populate.parse_text(u'kjav', t)
+
+    return benches
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs micro-benchmarks.')
+    parser.add_argument('-k', dest='filter', default='', help='only run benchmarks containing this')
+    parser.add_argument('--repeat', type=int, default=9)
+    parser.add_argument('--min-time', type=float, default=0.1, help='seconds per repetition')
+    parser.add_argument('--fixture', help='directory for the fixture (default: temporary)')
+    parser.add_argument('--save', help='saves results to this file as a baseline')
+    parser.add_argument('--compare', help='compares results against this baseline')
+    args = parser.parse_args()
+
+    # paths are relative to the current directory, not the fixture
+    for name in ('fixture', 'save', 'compare'):
+        if getattr(args, name): setattr(args, name, os.path.abspath(getattr(args, name)))
+    fixture = args.fixture or tempfile.mkdtemp(prefix='bible-bench-')
+    if not os.path.exists(os.path.join(fixture, 'db', 'bible.db')):
+        print >>sys.stderr, 'generating a fixture at %s...' % fixture
+        if os.path.exists(fixture) and not os.listdir(fixture): os.rmdir(fixture)
+        make_fixture(fixture)
+
+    os.chdir(fixture)
+    import bible
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'rb') as f: baseline = json.load(f)
+
+    results = {}
+    with bible.app.test_request_context('/'):
+        bible.app.preprocess_request()
+        for name, func in benchmarks():
+            if args.filter not in name: continue
+            result = results[name] = summarize(measure(func, args.repeat, args.min_time))
+            line = '%-24s %10.1f us +- %5.1f%%' % (name, result['median'] * 1e6,
+                                                 result['mad'] / result['median'] * 100)
+            if name in baseline:
+                base = baseline[name]
+                ratio = result['median'] / base['median']
+                # changes within the combined noise are not significant
+                noise = (result['mad'] + base['mad']) / base['median']
+                line += '   %6.2fx %s' % (ratio, '' if abs(ratio - 1) > max(noise * 2, 0.02) else '(~)')
+            print line
+
+    if args.save:
+        with open(args.save, 'wb') as f: json.dump(results, f, indent=1, sort_keys=True)
+    if not args.fixture: shutil.rmtree(fixture)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,59 @@
 # coding=utf-8
-from flask import Flask, g, render_template, current_app, request, redirect, abort, url_for
+from flask import Flask, g, render_template, current_app, request, redirect, abort, url_for, jsonify
+from flask import Response, stream_with_context, safe_join
 from jinja2.utils import Markup
 from werkzeug.routing import BaseConverter, ValidationError
 from werkzeug.datastructures import MultiDict
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
 from collections import namedtuple, OrderedDict
+from array import array
 import sys
+import os
 import re
 import sqlite3
 import urllib
+import hashlib
+import zlib
+import mimetypes
 import datetime
+import time
 import bisect
+import threading
+import itertools
+import traceback
+import bibledata
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 sqlite3.register_converter('book', int)
 
 app = Flask(__name__, static_folder='res', template_folder='tmpl')
+app.config.setdefault('DATABASE', 'db/bible.db')
+# number of idle connections kept per worker; more connections are opened as needed
+app.config.setdefault('DATABASE_POOL_SIZE', 8)
+app.config.setdefault('DATABASE_MMAP_SIZE', 256 * 1024 * 1024)
+# number of prepared statements cached per connection
+app.config.setdefault('DATABASE_CACHED_STATEMENTS', 256)
+# use the columnar verse stores written by populate.py, if any, for ordinal range queries
+app.config.setdefault('VERSE_STORE', True)
+# total bytes of rendered pages kept in memory per worker
+app.config.setdefault('PAGE_CACHE_SIZE', 64 * 1024 * 1024)
+# seconds for which browsers and proxies may reuse pages without revalidating their ETags
+app.config.setdefault('PAGE_MAX_AGE', 3600)
+# total characters of decompressed verse texts (and bytes of their compressed forms,
+# which are the keys) kept in memory per worker
+app.config.setdefault('TEXT_CACHE_SIZE', 8 * 1024 * 1024)
+# total characters (and bytes of meta) of verse rows kept in memory per worker
+app.config.setdefault('VERSE_CACHE_SIZE', 16 * 1024 * 1024)
+# the database file is checked for replacement once per this many requests
+app.config.setdefault('DATABASE_CHECK_INTERVAL', 100)
+# limits for a single request to /+/api/verses
+app.config.setdefault('API_MAX_REFERENCES', 100)
+app.config.setdefault('API_MAX_VERSES', 5000)
+# collect per-phase timings (see `timing`), reported in the Server-Timing header and /+/metrics
+app.config.setdefault('TIMING', False)
 
 @app.template_filter('classes')
 def filter_classes(v):
@@ -26,89 +65,22 @@ def filter_book(v):
     return mappings.books[v]
 
 @app.template_filter('htmltext')
-def filter_htmltext(s, meta=None, keywords=None):
+def filter_htmltext(s, meta=None, keywords=None, html=None):
     if not s: return u''
-    slower = s.lower()
-
-    if meta is not None:
-        extra = bytes(meta).split('\xff')
-        markup = map(ord, extra[0])
-        assert len(markup) == len(s) or len(markup) == len(s) + 1
-    else:
-        extra = []
-        markup = [0] * len(s)
-
-    kwmark = [None] * len(s)
-
-    # flags:
-    # * 127 (bit mask)
-    #     0 -- normal
-    #     1 -- italicized (artificial text in KJV)
-    #     2 -- Capitalized
-    #     3 -- UPPERCASED
-    # * 128 (bit mask) -- will fetch the annotation from the extra *before* this
-    # * 255 -- separators for markup
-
-    # add pseudo keyword marks for query highlighting
-    # marks are added in reverse, so the earlier keyword overwrites others.
-    for k, keyword in list(enumerate(keywords or ()))[::-1]:
-        keyword = keyword.lower()
-        pos = -1
-        while True:
-            pos = slower.find(keyword, pos+1)
-            if pos < 0: break
-            for i in xrange(pos, pos+len(keyword)):
-                kwmark[i] = k
-
-    ss = []
-    cur = []
-    prevstyle = 0
-    prevmark = None
-    nextann = 1 # since extra[0] == markup (if any)
-    lastflags = None
-    if len(markup) > len(s): # there are len(s)+1 positions where annotated text can go
-        lastflags = markup.pop()
-        assert (lastflags & 127) == 0 # annotated text only
-
-    for ch, flags, mark in zip(s, markup, kwmark) + [(u'', lastflags, None)]:
-        flags = flags or 0
-        style = flags & 127
-
-        if flags & 128:
-            ss.append(Markup().join(cur))
-            ss.append(Markup('<small>%s</small>') % extra[nextann].decode('utf-8'))
-            cur = []
-            nextann += 1
-
-        if not ch or (style, mark) != (prevstyle, prevmark):
-            ss.append(Markup().join(cur))
-            cur = []
-
-            closing = []
-            opening = []
-
-            cascade = False
-            if cascade or mark != prevmark:
-                if prevmark is not None: closing.append(Markup('</mark>'))
-                if mark is not None: opening.append(Markup('<mark class="keyword%d">' % mark))
-                cascade = True
-            if cascade or style != prevstyle:
-                if prevstyle:
-                    closing.append(Markup(('', '</i>', '</em>', '</strong>',
-                                           '</small>')[prevstyle]))
-                if style:
-                    opening.append(Markup(('', '<i>', '<em>', '<strong>',
-                                           '<small>')[style]))
-                cascade = True
-
-            prevstyle = style
-            prevmark = mark
-            ss.extend(closing[::-1])
-            ss.extend(opening)
-
-        cur.append(ch)
-
-    return Markup().join(ss)
+    matcher = keyword_matcher(keywords) if keywords else None
+    # the pre-rendered HTML can be used as long as no keyword has to be highlighted
+    if html is not None and not (matcher and matcher.occurs_in(s.lower())):
+        return Markup(html)
+    with timing('htmltext'):
+        return bibledata.render_htmltext(s, meta, matcher)
+
+# the matcher is built once per request, as all verses are highlighted with the same keywords
+def keyword_matcher(keywords):
+    keywords = tuple(keywords)
+    matcher = getattr(g, 'keyword_matcher', None)
+    if matcher is None or matcher.keywords != keywords:
+        matcher = g.keyword_matcher = bibledata.KeywordMatcher(keywords)
+    return matcher
 
 class Entry(sqlite3.Row):
     def __init__(self, *args, **kwargs):
@@ -138,14 +110,483 @@ class Entry(sqlite3.Row):
         else:
             return sqlite3.Row.__str__(self)
 
+# a dict-based counterpart of `Entry` for rows not coming from SQLite
+class Row(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+# a counterpart of `Entry` with `set_primary` called, used for `Mappings`
+class Record(Row):
+    def __init__(self, primary_field, *args, **kwargs):
+        Row.__init__(self, *args, **kwargs)
+        self._primary_field = primary_field
+
+    def __unicode__(self):
+        return unicode(self[self._primary_field])
+
+    def __str__(self):
+        return str(self[self._primary_field])
+
+    def __hash__(self):
+        return hash(self[self._primary_field])
+
+class Connection(sqlite3.Connection):
+    generation = None
+    lender = None # only set for the reserve connection of `ConnectionPool`
+
+# the database is never written at runtime, so connections are opened read-only
+# and reused across requests (and threads, but one thread at a time) to keep
+# their page and statement caches warm. populate.py replaces the file as a whole,
+# so connections opened before that keep reading the old generation of database
+# and are not returned to the pool after `reset`.
+#
+# the replacement is only noticed once in a while (see `check_database`), and a new
+# connection opened in between would read the new file while the old `Mappings` is
+# still in use. the pool therefore keeps a reserve connection to the file of the current
+# generation, which is lent (to one thread at a time) in place of such connections
+# until the reload finishes and calls `reset`.
+class ConnectionPool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.generation = None
+        self.reserve = None
+        # sqlite3 in Python 2 cannot ask for URI file names, so they are only recognized
+        # when SQLite itself is built with SQLITE_USE_URI; this is fixed for the process.
+        probe = sqlite3.connect(':memory:')
+        try:
+            self.uri, = probe.execute("select sqlite_compileoption_used('USE_URI');").fetchone()
+        finally:
+            probe.close()
+        if not self.uri:
+            print >>sys.stderr, (' * SQLite does not accept URI file names, '
+                                 'opening the database without mode=ro&immutable=1')
+
+    def connect(self):
+        path = app.config['DATABASE']
+        if self.uri:
+            # immutable=1 also disables locking, which is safe as the file is never modified
+            path = 'file:%s?mode=ro&immutable=1' % urllib.quote(path)
+        db = sqlite3.connect(path, detect_types=sqlite3.PARSE_COLNAMES, check_same_thread=False,
+                             cached_statements=app.config['DATABASE_CACHED_STATEMENTS'],
+                             factory=Connection)
+        db.row_factory = Entry
+        db.execute('pragma query_only = 1;') # also enforces read-only without a URI
+        db.execute('pragma mmap_size = %d;' % app.config['DATABASE_MMAP_SIZE'])
+        db.generation, = db.execute('pragma user_version;').fetchone()
+        db.create_function('expand', 2,
+                           text_expander(db.generation, bibledata.load_text_codecs(db)))
+        return db
+
+    def acquire(self):
+        with self.lock:
+            if self.idle: return self.idle.pop()
+            generation = self.generation
+        db = self.connect()
+        if generation is None or db.generation == generation: return db
+
+        db.close()
+        start_reload()
+        reserve = self.reserve
+        if reserve is None: return self.connect() # nothing better to do
+        reserve.lender.acquire()
+        if reserve is self.reserve: return reserve
+        reserve.lender.release() # replaced by `reset` in the meantime
+        return self.acquire()
+
+    def release(self, db):
+        if db.lender is not None:
+            db.lender.release()
+            with self.lock:
+                if db is self.reserve: return
+            db.close()
+            return
+        with self.lock:
+            if db.generation == self.generation and \
+                    len(self.idle) < app.config['DATABASE_POOL_SIZE']:
+                self.idle.append(db)
+                return
+        db.close()
+
+    # drops all idle connections and only keeps connections of given generation from now on
+    def reset(self, generation):
+        reserve = self.connect()
+        if reserve.generation == generation:
+            reserve.lender = threading.Lock()
+        else:
+            reserve.close() # already replaced again, to be noticed later
+            reserve = None
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.generation = generation
+            old, self.reserve = self.reserve, reserve
+        for db in idle: db.close()
+        # the old reserve is closed by `release` if it is being lent
+        if old is not None and old.lender.acquire(False):
+            old.lender.release()
+            old.close()
+
+pool = ConnectionPool()
+
+# verse texts may be compressed (see `bibledata.TextCodec`), so queries should read them
+# through the SQL function `expand(version, value)` which returns them as is otherwise.
+def text_expander(generation, codecs):
+    def expand(version, value):
+        if not isinstance(value, buffer): return value
+        key = generation, version, bytes(value)
+        text = text_cache.get(key)
+        if text is None:
+            text = codecs[version].decompress(value)
+            text_cache.put(key, text)
+        return text
+    return expand
+
+# a thread-safe LRU cache bounded by the total size of values (as per `sizeof`).
+# the budget is read from the app config at the insertion time.
+class LRUCache(object):
+    def __init__(self, budget_key, sizeof=len):
+        self.budget_key = budget_key
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value # move to the most recently used position
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        budget = app.config[self.budget_key]
+        size = self.sizeof(value)
+        if size > budget: return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.sizeof(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+# distinguishes a missing entry from any cached value, including None
+_missing = object()
+
+# an approximate LRU cache for many small values, where `LRUCache` would cost as much as
+# recomputing them: entries live in two plain dicts, and the older one is discarded when
+# the newer one fills a half of the budget. hits in the older dict are moved to the newer.
+# unlike `LRUCache`, `sizeof` is given both the key and the value.
+class TwoGenerationCache(object):
+    def __init__(self, budget_key, sizeof=lambda key, value: len(value)):
+        self.budget_key = budget_key
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.older = {}
+        self.size = 0 # of `recent` only
+
+    def get(self, key, default=None):
+        value = self.recent.get(key, _missing) # no locking needed for a single dict lookup
+        if value is _missing:
+            value = self.older.get(key, _missing)
+            if value is _missing: return default
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+        budget = app.config[self.budget_key] // 2
+        if size > budget: return # would discard everything else
+        with self.lock:
+            if self.size + size > budget:
+                self.older = self.recent
+                self.recent = {}
+                self.size = 0
+            self.recent[key] = value
+            self.size += size
+
+    def clear(self):
+        with self.lock:
+            self.recent = {}
+            self.older = {}
+            self.size = 0
+
+# rendered pages keyed by normalized request parameters. each page is a dict from
+# the content coding (None for the page itself, encoded in UTF-8) to the bytes.
+page_cache = LRUCache('PAGE_CACHE_SIZE', sizeof=lambda page: sum(map(len, page.values())))
+
+# decompressed verse texts keyed by (generation, version, compressed value)
+text_cache = TwoGenerationCache('TEXT_CACHE_SIZE',
+                                sizeof=lambda key, text: len(key[2]) + len(text))
+
+# (text, meta, html) of verses keyed by (generation, version, ordinal), or () if missing
+verse_cache = TwoGenerationCache('VERSE_CACHE_SIZE',
+                                 sizeof=lambda key, row: sum(len(v) for v in row if v is not None))
+
+# content codings of compressed variants, in the order of preference
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# `best` should be set for variants which are built only once
+def compress(data, encoding, best=False):
+    if encoding == 'gzip':
+        # unlike the gzip module, this doesn't put the current time into the header
+        compressor = zlib.compressobj(9 if best else 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    raise ValueError('unknown content coding %r' % encoding)
+
+# returns the preferred content coding for the current request, or None for no compression
+def negotiate_encoding(encodings=ENCODINGS):
+    return request.accept_encodings.best_match(encodings)
+
+# (mtime, compressed bytes) of static files keyed by (path, content coding). an entry is
+# replaced when the file changes, so this is bounded by the number of files in `res/`.
+static_variants = {}
+
+# replaces the default view for `res/`, which doesn't know about compression
+def static(filename):
+    encoding = negotiate_encoding()
+    path = safe_join(app.static_folder, filename)
+    if encoding is None or not os.path.isfile(path):
+        response = app.send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    mtime = os.stat(path).st_mtime
+    cachedmtime, data = static_variants.get((path, encoding), (None, None))
+    if cachedmtime != mtime:
+        with open(path, 'rb') as f:
+            data = compress(f.read(), encoding, best=True)
+        static_variants[path, encoding] = mtime, data
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = app.response_class(data, mimetype=mimetype)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.last_modified = mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = app.get_send_file_max_age(filename)
+    response.set_etag('%s-%s' % (hashlib.sha1(data).hexdigest(), encoding))
+    return response.make_conditional(request)
+
+app.view_functions['static'] = static
+
+# per-phase timings of the current request are accumulated to `g.timings` if enabled.
+# phases may nest (e.g. `jinja` includes `htmltext`).
+class PhaseTimer(object):
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        timings = getattr(g, 'timings', None)
+        if timings is not None:
+            timings[self.phase] = timings.get(self.phase, 0) + (time.time() - self.start)
+
+class NullTimer(object):
+    def __enter__(self): pass
+    def __exit__(self, *exc_info): pass
+
+NULL_TIMER = NullTimer()
+
+def timing(phase):
+    return PhaseTimer(phase) if app.config['TIMING'] else NULL_TIMER
+
+# request durations in seconds per route, for histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# per-route request counters and histograms, kept per worker process
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {} # (route, status): count
+        self.durations = {} # route: [count per bucket..., count, sum]
+        self.phases = {} # (route, phase): seconds
+
+    def record(self, route, status, duration, timings):
+        with self.lock:
+            self.requests[route, status] = self.requests.get((route, status), 0) + 1
+            counts = self.durations.get(route)
+            if counts is None:
+                counts = self.durations[route] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+            counts[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+            counts[-1] += duration
+            for phase, seconds in timings.items():
+                self.phases[route, phase] = self.phases.get((route, phase), 0) + seconds
+
+    # returns metrics in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            requests = sorted(self.requests.items())
+            durations = sorted((route, counts[:]) for route, counts in self.durations.items())
+            phases = sorted(self.phases.items())
+
+        lines = []
+        lines.append('# HELP bible_requests_total Number of requests.')
+        lines.append('# TYPE bible_requests_total counter')
+        for (route, status), count in requests:
+            lines.append('bible_requests_total{route="%s",status="%d"} %d' % (route, status, count))
+        lines.append('# HELP bible_request_duration_seconds Request duration.')
+        lines.append('# TYPE bible_request_duration_seconds histogram')
+        for route, counts in durations:
+            cumulative = 0
+            for le, count in zip(DURATION_BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                lines.append('bible_request_duration_seconds_bucket{route="%s",le="%s"} %d' %
+                             (route, le, cumulative))
+            lines.append('bible_request_duration_seconds_sum{route="%s"} %r' % (route, counts[-1]))
+            lines.append('bible_request_duration_seconds_count{route="%s"} %d' % (route, cumulative))
+        lines.append('# HELP bible_phase_seconds_total Time spent in each phase of requests.')
+        lines.append('# TYPE bible_phase_seconds_total counter')
+        for (route, phase), seconds in phases:
+            lines.append('bible_phase_seconds_total{route="%s",phase="%s"} %r' %
+                         (route, phase, seconds))
+        lines.append('# HELP bible_page_cache_requests_total Page cache lookups.')
+        lines.append('# TYPE bible_page_cache_requests_total counter')
+        lines.append('bible_page_cache_requests_total{result="hit"} %d' % page_cache.hits)
+        lines.append('bible_page_cache_requests_total{result="miss"} %d' % page_cache.misses)
+        lines.append('# HELP bible_page_cache_bytes Total size of cached pages.')
+        lines.append('# TYPE bible_page_cache_bytes gauge')
+        lines.append('bible_page_cache_bytes %d' % page_cache.size)
+        lines.append('# HELP bible_database_generation Generation of the loaded database.')
+        lines.append('# TYPE bible_database_generation gauge')
+        lines.append('bible_database_generation %d' % mappings.generation)
+        return '\n'.join(lines) + '\n'
+
+route_metrics = Metrics()
+
+@app.before_request
+def start_timing():
+    if app.config['TIMING']:
+        g.request_start = time.time()
+        g.timings = OrderedDict()
+
+# streamed pages (see `cached_stream`) are rendered while being sent, so they are recorded
+# once the response is closed. their Server-Timing can only cover the time until headers.
+@app.after_request
+def finish_timing(response):
+    timings = getattr(g, 'timings', None)
+    if timings is None or request.endpoint == 'metrics': return response
+    route = request.endpoint or ''
+    status = response.status_code
+    start = g.request_start
+    duration = time.time() - start
+    if response.is_streamed:
+        def record():
+            # `timings` is still filled by the stream, which keeps `g` until it finishes
+            route_metrics.record(route, status, time.time() - start, timings)
+        response.call_on_close(record)
+        total = 'headers'
+    else:
+        route_metrics.record(route, status, duration, timings)
+        total = 'total'
+    response.headers['Server-Timing'] = ', '.join(
+            ['%s;dur=%.3f' % (phase, seconds * 1000) for phase, seconds in timings.items()] +
+            ['%s;dur=%.3f' % (total, duration * 1000)])
+    return response
+
 @contextmanager
 def database():
-    db = sqlite3.connect('db/bible.db', detect_types=sqlite3.PARSE_COLNAMES)
-    db.row_factory = Entry
+    db = pool.acquire()
     try:
         yield db
     finally:
-        db.close()
+        pool.release(db)
+
+# finds (ordinal1, ordinal2, value) ranges covering or overlapping given ordinals, looking at
+# O(log n) ranges plus those near the ordinals. ranges are grouped by their lengths in powers
+# of two and sorted by ordinal1, so that only ranges in a group starting less than twice
+# the group's minimum length before the ordinals can overlap and need to be checked.
+class RangeIndex(object):
+    def __init__(self, ranges):
+        self.values = []
+        groups = {}
+        for ordinal1, ordinal2, value in ranges:
+            assert ordinal1 <= ordinal2
+            level = (ordinal2 - ordinal1 + 1).bit_length() - 1
+            groups.setdefault(level, []).append((ordinal1, ordinal2, len(self.values)))
+            self.values.append(value)
+
+        # (maximum length + 1, ordinal1s, ordinal2s, indices to `values`) for each group
+        self.groups = []
+        for level, group in sorted(groups.items()):
+            group.sort()
+            self.groups.append((2 << level,) +
+                               tuple(array('i', [row[i] for row in group]) for i in xrange(3)))
+
+    # returns values of ranges overlapping ordinal1 through ordinal2 (inclusive),
+    # in the order they were given
+    def overlapping(self, ordinal1, ordinal2):
+        found = []
+        for span, starts, ends, indices in self.groups:
+            lo = bisect.bisect_right(starts, ordinal1 - span)
+            hi = bisect.bisect_right(starts, ordinal2)
+            found.extend(indices[i] for i in xrange(lo, hi) if ends[i] >= ordinal1)
+        found.sort()
+        return [self.values[i] for i in found]
+
+    def covering(self, ordinal):
+        return self.overlapping(ordinal, ordinal)
+
+_triple = namedtuple('triple', 'book chapter verse index ordinal')
+class triple(_triple):
+    # `ChapterTable.bookslots` of the current `mappings`; each `Mappings` also has a subclass
+    # for its own table as `Mappings.triple`. this is made on every page, so the lookup is
+    # inlined and the tuple is made without `_triple.__new__`, which costs as much as the lookup.
+    bookslots = {}
+
+    def __new__(cls, book, chapter, verse):
+        try:
+            minchapter, maxchapter, ints, base = cls.bookslots[book]
+        except KeyError:
+            raise ValueError('invalid book')
+        if chapter == '$': chapter = maxchapter
+        elif chapter <= 0: chapter = minchapter
+        elif not minchapter <= chapter <= maxchapter: raise ValueError('invalid chapter')
+        i = base + 4 * chapter
+        minverse, maxverse, deltaindex, deltaordinal = ints[i:i+4]
+        if verse == '$': verse = maxverse
+        elif verse <= 0: verse = minverse
+        if not (minverse <= verse <= maxverse):
+            # missing chapters have an empty verse range
+            raise ValueError('invalid verse' if minverse <= maxverse else 'invalid chapter')
+        index = deltaindex + verse
+        ordinal = deltaordinal + verse
+        return tuple.__new__(cls, (book, chapter, verse, index, ordinal))
+
+    @property
+    def book_and_chapter(self):
+        return (self.book, self.chapter)
+
+    @property
+    def min_verse_in_chapter(self):
+        _, _, ints, base = self.bookslots[self.book]
+        return ints[base + 4 * self.chapter]
+
+    @property
+    def max_verse_in_chapter(self):
+        _, _, ints, base = self.bookslots[self.book]
+        return ints[base + 4 * self.chapter + 1]
 
 # a universal cache for immutable data
 class Mappings(object):
@@ -157,70 +598,96 @@ class Mappings(object):
         return u''.join(s.split()).upper()
 
     def reload(self):
-        with database() as db:
-            self.books = []
-            self.bookaliases = {}
-            self.versions = {}
-            self.versionaliases = {}
-            self.blessedversions = {}
-
-            # book: (minchapter, maxchapter)
-            self.chapterranges = {}
-            # (book,verse): (minverse, maxverse, deltaindex, deltaordinal)
-            self.verseranges = {}
-            # lexicographical_code: [(minordinal, maxordinal), ...]
-            dailyranges = {}
-
-            for row in db.execute('select * from books order by book;'):
-                assert len(self.books) == row['book']
-                row.set_primary('code')
-                self.books.append(row)
-                self.bookaliases[row['book']] = row
-            for row in db.execute('select * from bookaliases;'):
-                self.bookaliases[row['alias']] = self.books[row['book']], row['lang']
-            for row in db.execute('select * from versions;'):
-                row.set_primary('version')
-                self.versions[row['version']] = row
-                self.versionaliases[self.normalize(row['version'])] = row
-                if row['blessed']:
-                    self.blessedversions[row['lang']] = row
-            for row in db.execute('select * from versionaliases;'):
-                self.versionaliases[row['alias']] = self.versions[row['version']]
-
-            for row in db.execute('''select book,
-                                            min(chapter) as minchapter,
-                                            max(chapter) as maxchapter
-                                     from verses group by book;'''):
-                self.chapterranges[row['book']] = \
-                        (row['minchapter'], row['maxchapter'])
-            for row in db.execute('''select book, chapter,
-                                            min(verse) as minverse,
-                                            max(verse) as maxverse,
-                                            min("index") as minindex,
-                                            max("index") as maxindex,
-                                            min(ordinal) as minordinal,
-                                            max(ordinal) as maxordinal
-                                     from verses group by book, chapter;'''):
-                assert (row['maxverse'] - row['minverse'] ==
-                        row['maxindex'] - row['minindex'] ==
-                        row['maxordinal'] - row['minordinal'])
-                self.verseranges[row['book'], row['chapter']] = \
-                        (row['minverse'], row['maxverse'],
-                         row['minindex'] - row['minverse'],
-                         row['minordinal'] - row['minverse'])
-            for row in db.execute('''select code,
-                                            v1.book as book1, v1.chapter as chapter1, v1.verse as verse1,
-                                            v2.book as book2, v2.chapter as chapter2, v2.verse as verse2
-                                     from topics
-                                          inner join verses v1 on v1.ordinal = ordinal1
-                                          inner join verses v2 on v2.ordinal = ordinal2
-                                     where kind = ?;''', ('daily',)):
-                bcv1 = (row['book1'], row['chapter1'], row['verse1'])
-                bcv2 = (row['book2'], row['chapter2'], row['verse2'])
-                dailyranges.setdefault(row['code'], []).append((bcv1, bcv2))
-
-            for ranges in dailyranges.values(): ranges.sort()
-            self.dailyranges = sorted(dailyranges.items())
+        # taken before opening the database, so that any later replacement is noticed
+        self.signature = database_signature()
+        with closing(pool.connect()) as db:
+            self.generation = db.generation
+            data = bibledata.load_mappings(db, db.generation)
+
+        self.books = []
+        self.bookaliases = {}
+        self.versions = {}
+        self.versionaliases = {}
+        self.blessedversions = {}
+
+        # lexicographical_code: [(minordinal, maxordinal), ...]
+        dailyranges = {}
+
+        for row in data['books']:
+            assert len(self.books) == row['book']
+            row = Record('code', row)
+            self.books.append(row)
+            self.bookaliases[row['book']] = row
+        for alias, book, lang in data['bookaliases']:
+            self.bookaliases[alias] = self.books[book], lang
+        for row in data['versions']:
+            row = Record('version', row)
+            self.versions[row['version']] = row
+            self.versionaliases[self.normalize(row['version'])] = row
+            if row['blessed']:
+                self.blessedversions[row['lang']] = row
+        for alias, version in data['versionaliases']:
+            self.versionaliases[alias] = self.versions[version]
+
+        for code, bcv1, bcv2 in data['dailyranges']:
+            dailyranges.setdefault(code, []).append((bcv1, bcv2))
+
+        for ranges in dailyranges.values(): ranges.sort()
+        self.dailyranges = sorted(dailyranges.items())
+
+        # kind: [(code, [(ordinal1, ordinal2), ...]), ...] for every reading plan, sorted by codes
+        self.planranges = {}
+        for kind, code, ordinal1, ordinal2 in data['plans']:
+            days = self.planranges.setdefault(kind, [])
+            if not days or days[-1][0] != code: days.append((code, []))
+            days[-1][1].append((ordinal1, ordinal2))
+        # (kind, code) by ordinal ranges, in the order of kinds and codes
+        self.planindex = RangeIndex((ordinal1, ordinal2, (kind, code))
+                                    for kind, code, ordinal1, ordinal2 in data['plans'])
+
+        # a trie of normalized aliases, where each node is a dict from a character to the child
+        # node. nodes for complete aliases also have 'book' and/or 'version' keys (which never
+        # collide with characters) for `bookaliases` and `versionaliases` values respectively.
+        self.aliastrie = {}
+        for kind, aliases in (('book', self.bookaliases), ('version', self.versionaliases)):
+            for alias, value in aliases.items():
+                if not isinstance(alias, basestring): continue # book numbers
+                node = self.aliastrie
+                for ch in alias: node = node.setdefault(ch, {})
+                node[kind] = value
+
+        # chapters and verses (see `bibledata.ChapterTable`), mapped from the file written
+        # by populate.py or built from the snapshot if the file is missing or stale
+        self.chapters = None
+        path = bibledata.chapter_table_path(app.config['DATABASE'])
+        if os.path.exists(path):
+            chapters = bibledata.ChapterTable.open(path)
+            if chapters.generation == self.generation:
+                self.chapters = chapters
+            else:
+                chapters.close()
+        if self.chapters is None:
+            self.chapters = bibledata.ChapterTable(bibledata.build_chapter_table(
+                    self.generation, data['chapterranges'], data['verseranges']))
+        self.numordinals = numordinals = self.chapters.numordinals
+        self.triple = type('triple', (triple,), {'bookslots': self.chapters.bookslots})
+
+        # stores are replaced before the database, so a store not matching the generation
+        # recorded in the database (or older stores without one) is ignored in favor of SQL
+        self.verse_stores = {}
+        if app.config['VERSE_STORE']:
+            storegenerations = dict(data['versestores'])
+            for version in self.versions:
+                path = bibledata.verse_store_path(app.config['DATABASE'], version)
+                if version not in storegenerations or not os.path.exists(path): continue
+                try:
+                    store = bibledata.VerseStore(path)
+                except ValueError:
+                    continue
+                if store.generation == storegenerations[version] and store.count == numordinals:
+                    self.verse_stores[version] = store
+                else:
+                    store.close()
 
         # TODO
         self.DEFAULT_VER = self.blessedversions['ko']['version']
@@ -243,7 +710,38 @@ class Mappings(object):
         index = bisect.bisect_right(self.dailyranges, (code + unichr(sys.maxunicode),))
         assert index <= 0 or self.dailyranges[index-1][0] <= code
         assert index >= len(self.dailyranges) or self.dailyranges[index][0] > code
-        return Daily(index-1)
+        return self.get_daily(index-1)
+
+    # `Daily` instances are built once (on the first use) and shared
+    def get_daily(self, index):
+        return self.get_dailies()[index % len(self.dailyranges)]
+
+    def get_dailies(self):
+        dailies = getattr(self, 'dailies', None)
+        if dailies is None:
+            dailies = self.dailies = [Daily(self, i) for i in xrange(len(self.dailyranges))]
+        return dailies
+
+    # returns a list of (kind, code) of reading plans overlapping given ordinals
+    def find_plans(self, ordinal1, ordinal2):
+        plans = []
+        for plan in self.planindex.overlapping(ordinal1, ordinal2):
+            if not plans or plans[-1] != plan: plans.append(plan)
+        return plans
+
+    # returns the index of given code in a reading plan for `PlanDay`, or None if missing
+    def find_plan_day(self, kind, code):
+        days = self.planranges.get(kind, [])
+        index = bisect.bisect_left(days, (code,))
+        if index < len(days) and days[index][0] == code: return index
+        return None
+
+    # returns (book, chapter, verse) for given ordinal
+    def locate(self, ordinal):
+        i = self.chapters.find_chapter(ordinal)
+        if i < 0: raise ValueError('invalid ordinal')
+        _, book, chapter, _, deltaordinal = self.chapters.chapter_at(i)
+        return book, chapter, ordinal - deltaordinal
 
     def to_ordinal(self, (b,c,v)):
         try:
@@ -256,7 +754,53 @@ class Mappings(object):
             raise ValueError('invalid book-chapter-verse pair')
         return ord
 
+def database_signature():
+    st = os.stat(app.config['DATABASE'])
+    return st.st_ino, st.st_size, st.st_mtime
+
 mappings = Mappings()
+triple.bookslots = mappings.chapters.bookslots
+pool.reset(mappings.generation)
+
+# populate.py atomically renames a new database into place. requests only stat the file
+# once in a while, and a new `Mappings` is built in the background while other requests
+# continue with the current one; it is then swapped in along with anything depending on
+# the old generation. (requires threads to be enabled in uWSGI.)
+request_counter = itertools.count()
+reload_lock = threading.Lock()
+
+@app.before_request
+def check_database():
+    if next(request_counter) % app.config['DATABASE_CHECK_INTERVAL']: return
+    try:
+        if database_signature() == mappings.signature: return
+    except OSError:
+        return # being replaced; try again later
+    start_reload()
+
+def start_reload():
+    if not reload_lock.acquire(False): return # already reloading
+    thread = threading.Thread(target=reload_mappings)
+    thread.daemon = True
+    thread.start()
+
+def reload_mappings():
+    global mappings
+    try:
+        new = Mappings()
+        if new.generation == mappings.generation:
+            mappings.signature = new.signature # touched but not replaced
+        else:
+            mappings = new
+            triple.bookslots = new.chapters.bookslots
+            pool.reset(new.generation)
+            page_cache.clear()
+            print >>sys.stderr, ' * Reloaded database generation %d' % new.generation
+    except Exception:
+        traceback.print_exc()
+    finally:
+        reload_lock.release()
+
 @app.context_processor
 def inject_mappings():
     return {
@@ -265,47 +809,13 @@ def inject_mappings():
         'build_query_suffix': build_query_suffix,
     }
 
-_triple = namedtuple('triple', 'book chapter verse index ordinal')
-class triple(_triple):
-    def __new__(cls, book, chapter, verse):
-        try:
-            minchapter, maxchapter = mappings.chapterranges[book]
-        except KeyError:
-            raise ValueError('invalid book')
-        if chapter == '$': chapter = maxchapter
-        elif chapter <= 0: chapter = minchapter
-        try:
-            minverse, maxverse, deltaindex, deltaordinal = mappings.verseranges[book, chapter]
-        except KeyError:
-            raise ValueError('invalid chapter')
-        if verse == '$': verse = maxverse
-        elif verse <= 0: verse = minverse
-        if not (minverse <= verse <= maxverse):
-            raise ValueError('invalid verse')
-        index = deltaindex + verse
-        ordinal = deltaordinal + verse
-        return _triple.__new__(cls, book, chapter, verse, index, ordinal)
-
-    @property
-    def book_and_chapter(self):
-        return (self.book, self.chapter)
-
-    @property
-    def min_verse_in_chapter(self):
-        minverse, maxverse, deltaindex, deltaordinal = mappings.verseranges[self.book, self.chapter]
-        return minverse
-
-    @property
-    def max_verse_in_chapter(self):
-        minverse, maxverse, deltaindex, deltaordinal = mappings.verseranges[self.book, self.chapter]
-        return maxverse
-
 class Daily(object):
-    def __init__(self, index):
+    def __init__(self, mappings, index):
         code, ranges = mappings.dailyranges[index]
+        self.mappings = mappings
         self.index = index
         self.code = code
-        self.ranges = [(triple(*bcv1), triple(*bcv2)) for bcv1, bcv2 in ranges]
+        self.ranges = [(mappings.triple(*bcv1), mappings.triple(*bcv2)) for bcv1, bcv2 in ranges]
         self.month, self.day = map(int, code.split('-', 1))
 
     @property
@@ -322,11 +832,40 @@ class Daily(object):
 
     @property
     def prev(self):
-        return Daily((self.index - 1) % len(mappings.dailyranges))
+        return self.mappings.get_daily(self.index - 1)
 
     @property
     def next(self):
-        return Daily((self.index + 1) % len(mappings.dailyranges))
+        return self.mappings.get_daily(self.index + 1)
+
+# a unit of reading plans other than the daily one, which can be identified by any code
+class PlanDay(object):
+    def __init__(self, mappings, kind, index):
+        days = mappings.planranges[kind]
+        code, ranges = days[index % len(days)]
+        self.mappings = mappings
+        self.kind = kind
+        self.index = index % len(days)
+        self.code = code
+        self.ranges = [(mappings.triple(*mappings.locate(ordinal1)),
+                        mappings.triple(*mappings.locate(ordinal2)))
+                       for ordinal1, ordinal2 in ranges]
+
+    @property
+    def start(self):
+        return self.ranges[0][0]
+
+    @property
+    def end(self):
+        return self.ranges[-1][1]
+
+    @property
+    def prev(self):
+        return PlanDay(self.mappings, self.kind, self.index - 1)
+
+    @property
+    def next(self):
+        return PlanDay(self.mappings, self.kind, self.index + 1)
 
 
 class Normalizable(namedtuple('Normalizable', 'before after')):
@@ -335,6 +874,7 @@ class Normalizable(namedtuple('Normalizable', 'before after')):
     def __getattr__(self, name): return getattr(self.after, name)
 
 sqlite3.register_adapter(Entry, str)
+sqlite3.register_adapter(Record, str)
 sqlite3.register_adapter(Normalizable, str)
 
 class BookConverter(BaseConverter):
@@ -368,7 +908,7 @@ app.url_map.converters['int_or_end'] = IntOrEndConverter
 def build_query_suffix(**repl):
     searching = repl.pop('_searching', False)
 
-    normalized_version = str(g.version1) + (','+str(g.version2) if g.version2 else '')
+    normalized_version = ','.join(map(str, g.versions))
     normalized_cursor = str(g.cursor) if g.cursor is not None else ''
 
     newquery = MultiDict(request.args)
@@ -393,22 +933,24 @@ def build_query_suffix(**repl):
         return ''
 
 def normalize_url(self, **kwargs):
+    with timing('normalize_url'):
+        do_normalize_url(self, **kwargs)
+
+def do_normalize_url(self, **kwargs):
     searching = kwargs.pop('_searching', False)
 
     # common parameter `v`: version(s)
-    # v=<v1> or v=<v1>,<v2>
+    # v=<v1> or v=<v1>,<v2>,... (unknown or duplicate versions other than the first are removed)
     orig_version = request.args.get('v', '')
-    v1, _, v2 = orig_version.partition(',')
-    try:
-        g.version1 = mappings.find_version_by_alias(v1)
-    except Exception:
-        g.version1 = mappings.versions[mappings.DEFAULT_VER]
-    try:
-        g.version2 = mappings.find_version_by_alias(v2)
-        if g.version1 == g.version2: g.version2 = None
-    except Exception:
-        g.version2 = None
-    normalized_version = str(g.version1) + (','+str(g.version2) if g.version2 else '')
+    g.versions = []
+    for i, v in enumerate(orig_version.split(',')):
+        try:
+            version = mappings.find_version_by_alias(v)
+        except Exception:
+            if i > 0: continue
+            version = mappings.versions[mappings.DEFAULT_VER]
+        if version not in g.versions: g.versions.append(version)
+    normalized_version = ','.join(map(str, g.versions))
     # same caveat to build_query_suffix applies for the searching.
     if not searching and normalized_version == mappings.DEFAULT_VER: normalized_version = ''
 
@@ -431,7 +973,7 @@ def normalize_url(self, **kwargs):
             normalized_kwargs[k] = after
             need_redirect = need_redirect or after != before
         else:
-            normalized_kwargs[k] = str(v).encode('utf-8')
+            normalized_kwargs[k] = unicode(v).encode('utf-8')
 
     if need_redirect:
         abort(redirect(url_for(self, **normalized_kwargs) +
@@ -448,51 +990,225 @@ def normalize_url(self, **kwargs):
             if keyword: keywords.append(keyword)
         g.keywords = keywords
 
+# returns a cached page for the current request or renders it with `render`.
+# this should be called after `normalize_url`, with `key` sufficient to identify
+# the page given the normalized common parameters.
+def cached_page(render, *key):
+    key = page_key(key)
+    check_etag(key)
+    page = page_cache.get(key)
+    if page is None:
+        page = {None: render().encode('utf-8')}
+        page_cache.put(key, page)
+    return page_response(key, page)
+
+# same to `cached_page`, but `generate` returns an iterable of chunks (see `stream_verses`),
+# which are streamed to the client and cached once complete. the response is sent before
+# the page is rendered, so rendering phases are only recorded to metrics (see `finish_timing`).
+# chunks are gzipped on the fly if possible, and flushed so that they can be shown early.
+def cached_stream(generate, *key):
+    key = page_key(key)
+    check_etag(key)
+    page = page_cache.get(key)
+    if page is not None: return page_response(key, page)
+
+    chunks = generate()
+    encoding = negotiate_encoding(('gzip',))
+    def stream():
+        page = []
+        compressed = []
+        if encoding:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            chunk = chunk.encode('utf-8')
+            page.append(chunk)
+            if encoding:
+                chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                compressed.append(chunk)
+            yield chunk
+        variants = {None: ''.join(page)}
+        if encoding:
+            chunk = compressor.flush()
+            compressed.append(chunk)
+            yield chunk
+            variants[encoding] = ''.join(compressed)
+        page_cache.put(key, variants)
+    response = Response(stream_with_context(stream()), mimetype='text/html')
+    if encoding: response.headers['Content-Encoding'] = encoding
+    return response
+
+# same to `cached_page`, but for pages without common parameters which only change every
+# day, like the index. pages for previous days are never hit again after the local midnight.
+def dated_page(render, today):
+    key = (mappings.generation, request.endpoint, request.url_root, today)
+    check_etag(key, max_age=seconds_until_tomorrow())
+    page = page_cache.get(key)
+    if page is None:
+        page = {None: render().encode('utf-8')}
+        page_cache.put(key, page)
+    return page_response(key, page)
+
+# returns a response for the cached `page` with the preferred content coding.
+# a variant is compressed when first requested, and kept along with the page.
+def page_response(key, page):
+    encoding = negotiate_encoding()
+    data = page.get(encoding)
+    if data is None:
+        data = compress(page[None], encoding)
+        page = dict(page)
+        page[encoding] = data
+        page_cache.put(key, page)
+    response = Response(data, mimetype='text/html')
+    if encoding: response.headers['Content-Encoding'] = encoding
+    return response
+
+def page_key(key):
+    # other query parameters are retained in the links (see `build_query_suffix`)
+    args = tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k not in ('v', 'c')))
+    return (mappings.generation, request.endpoint, request.url_root) + key + \
+           (tuple(map(str, g.versions)), g.cursor, tuple(g.keywords), args)
+
+# pages are identified by their keys (see `page_key`), which also make strong ETags along
+# with the code. a matching If-None-Match is answered before anything is fetched or rendered.
+# compressed variants have the content coding appended, as they are different representations.
+def check_etag(key, max_age=None):
+    g.etag = hashlib.sha1(repr((CODE_HASH, key))).hexdigest()
+    g.max_age = app.config['PAGE_MAX_AGE'] if max_age is None else max_age
+    for encoding in (None,) + ENCODINGS:
+        if encoding and not request.accept_encodings[encoding]: continue
+        etag = variant_etag(g.etag, encoding)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            abort(response)
+
+def variant_etag(etag, encoding):
+    return '%s-%s' % (etag, encoding) if encoding else etag
+
+@app.after_request
+def add_cache_headers(response):
+    etag = getattr(g, 'etag', None)
+    if etag is not None and response.status_code in (200, 304):
+        if response.status_code == 200:
+            response.set_etag(variant_etag(etag, response.headers.get('Content-Encoding')))
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = g.max_age
+    return response
+
+# pages depending on the date expire at the next local midnight
+def seconds_until_tomorrow():
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return int((tomorrow - now).total_seconds())
+
+# the hash of everything but the database which may affect pages
+def code_hash():
+    h = hashlib.sha1()
+    paths = [os.path.join(app.root_path, name) for name in ('bible.py', 'bibledata.py')]
+    folder = os.path.join(app.root_path, app.template_folder)
+    paths += sorted(os.path.join(folder, name) for name in os.listdir(folder))
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(os.path.basename(path) + '\0' + f.read())
+    return h.hexdigest()
+
+CODE_HASH = code_hash()
+
+# rendered templates are streamed in chunks of this many pieces of Jinja output
+STREAM_BUFFER_SIZE = 200
+
 def render_verses(tmpl, (prevc, verses, nextc), **kwargs):
     query = kwargs.get('query', None)
     highlight = kwargs.get('highlight', None)
     if 'keywords' not in kwargs: kwargs['keywords'] = g.keywords
 
-    prev = None
-    prevhl = False
-    rows = []
-    tbodys = []
-    for verse in verses:
-        hl = highlight(verse['book'], verse['chapter'], verse['verse']) if highlight else False
-        if prevhl != hl:
-            sclasses = []
-            if prevhl: sclasses.append('highlight')
-            if rows: tbodys.append({'classes': sclasses, 'verses': rows})
-            rows = []
-            prevhl = hl
-
-        text = verse['text']
-        meta = verse['meta']
-        prefix = u''
-        vclasses = []
-        if (verse['book'], verse['chapter'], verse['verse']-1) == prev:
-            vclasses.append('cont')
-        rows.append({
-            'book': mappings.books[verse['book']],
-            'chapter': verse['chapter'],
-            'classes': vclasses,
-            'verse': verse['verse'],
-            'prefix': prefix,
-            'text': text,
-            'meta': meta,
-            'text2': verse['text2'] if 'text2' in verse.keys() else None,
-            'meta2': verse['meta2'] if 'meta2' in verse.keys() else None,
-        })
-        prev = (verse['book'], verse['chapter'], verse['verse'])
-    if rows:
-        sclasses = []
-        if prevhl: sclasses.append('highlight')
-        tbodys.append({'classes': sclasses, 'verses': rows})
-
-    return render_template(tmpl, version1=g.version1, version2=g.version2,
-                           sections=tbodys, prevc=prevc, nextc=nextc, **kwargs)
-
-def execute_verses_query(db, cursor=None, where='1', args=(), count=100):
+    with timing('rows'):
+        tbodys = build_sections(verses, highlight)
+    with timing('jinja'):
+        return render_template(tmpl, versions=g.versions,
+                               sections=tbodys, prevc=prevc, nextc=nextc, **kwargs)
+
+def build_sections(verses, highlight):
+    return [dict(section, verses=list(section['verses']))
+            for section in iter_sections(verses, highlight)]
+
+# yields sections of consecutive verses with the same highlighting. verses in each section
+# are also generated lazily, and should be consumed before advancing to the next section.
+def iter_sections(verses, highlight):
+    prev = [None]
+    def build_rows(verses):
+        for verse in verses:
+            texts = [(verse['text'], verse['meta'], verse['html'])]
+            if 'others' in verse.keys(): texts += verse['others']
+            prefix = u''
+            vclasses = []
+            if (verse['book'], verse['chapter'], verse['verse']-1) == prev[0]:
+                vclasses.append('cont')
+            yield {
+                'book': mappings.books[verse['book']],
+                'chapter': verse['chapter'],
+                'classes': vclasses,
+                'verse': verse['verse'],
+                'prefix': prefix,
+                # a list of (version, text, meta, html)
+                'texts': [(version,) + text for version, text in zip(g.versions, texts)],
+            }
+            prev[0] = (verse['book'], verse['chapter'], verse['verse'])
+
+    key = lambda verse: bool(highlight(verse['book'], verse['chapter'], verse['verse'])) \
+                        if highlight else False
+    for hl, group in itertools.groupby(verses, key=key):
+        yield {'classes': ['highlight'] if hl else [], 'verses': build_rows(group)}
+
+# same to `render_verses`, but returns an iterable of rendered chunks. the template should not
+# depend on the number of sections or verses (e.g. `{% if sections %}`).
+def stream_verses(tmpl, (prevc, verses, nextc), **kwargs):
+    if 'keywords' not in kwargs: kwargs['keywords'] = g.keywords
+    sections = iter_sections(verses, kwargs.get('highlight', None))
+    return stream_template(tmpl, versions=g.versions,
+                           sections=sections, prevc=prevc, nextc=nextc, **kwargs)
+
+def stream_template(name, **context):
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream
+
+# the candidate ordinals are fed into the query in batches of this size
+ORDINAL_BATCH = 500
+
+# `ranges` is a list of (minordinal, maxordinal) pairs further restricting the verses.
+# when given without any other condition, verses are sliced from verse stores or cached rows.
+def execute_verses_query(db, cursor=None, where='1', args=(), count=100, ordinals=None,
+                         ranges=None):
+    if ranges is not None:
+        if where == '1' and ordinals is None:
+            return fetch_verses_by_ranges(db, g.versions, cursor, ranges, count)
+        where += ' and (%s)' % (' or '.join(['v.ordinal between ? and ?'] * len(ranges)) or '0')
+        args += tuple(ordinal for minmax in ranges for ordinal in minmax)
+
+    if ordinals is not None:
+        # `ordinals` is a sorted list of candidates, which can be much larger than `count`.
+        # we only need to look at candidates following the cursor until we've got enough.
+        inverted = cursor is not None and cursor < 0
+        if cursor is None:
+            pass
+        elif cursor >= 0:
+            ordinals = ordinals[bisect.bisect_left(ordinals, cursor):]
+        else:
+            ordinals = ordinals[:bisect.bisect_right(ordinals, ~cursor)][::-1]
+
+        verses = []
+        for i in xrange(0, len(ordinals), ORDINAL_BATCH):
+            batch = ordinals[i:i+ORDINAL_BATCH]
+            rows = execute_verses_query(db, cursor,
+                    where + ' and v.ordinal in (%s)' % ','.join('?' * len(batch)),
+                    args + tuple(batch), count - len(verses) if count else None)
+            verses = rows + verses if inverted else verses + rows
+            if count and len(verses) >= count: break
+        return verses
+
     inverted = False
     if cursor is not None:
         if cursor >= 0:
@@ -508,27 +1224,198 @@ def execute_verses_query(db, cursor=None, where='1', args=(), count=100):
         limit = ' limit ?'
         args += (count,)
 
-    if g.version2:
-        verses = db.execute('''
-            select v.book as "book [book]", v.*, d.text as text, d.meta as meta,
-                        d2.text as text2, d2.meta as meta2
-            from verses v left outer join data d on d.version=? and v.ordinal=d.ordinal
-                          left outer join data d2 on d2.version=? and v.ordinal=d2.ordinal
-            where ''' + where + '''
-            order by ordinal ''' + ('desc' if inverted else 'asc') + limit + ''';
-        ''', (g.version1, g.version2) + args)
-    else:
-        verses = db.execute('''
-            select v.book as "book [book]", v.*, d.text as text, d.meta as meta
-            from verses v left outer join data d on d.version=? and v.ordinal=d.ordinal
-            where ''' + where + '''
-            order by ordinal ''' + ('desc' if inverted else 'asc') + limit + ''';
-        ''', (g.version1,) + args)
+    # `where` may refer to the text of the first version as `d`.
+    # rows are converted to `Row`s if there are other versions, so `Entry` is not needed then.
+    cursor = db.cursor()
+    if len(g.versions) > 1: cursor.row_factory = None
+    verses = cursor.execute('''
+        select v.book as "book [book]", v.*,
+                    expand(d.version, d.text) as text, d.meta as meta,
+                    expand(d.version, coalesce(d.html, d.text)) as html
+        from verses v left outer join data d on d.version=? and v.ordinal=d.ordinal
+        where ''' + where + '''
+        order by ordinal ''' + ('desc' if inverted else 'asc') + limit + ''';
+    ''', (g.versions[0],) + args)
 
     verses = verses.fetchall()
     if inverted: verses.reverse()
+    if len(g.versions) > 1:
+        keys = [column[0] for column in cursor.description]
+        verses = add_other_versions(db, keys, verses, g.versions[1:])
     return verses
 
+# returns `verses` (tuples with columns `keys`) as `Row`s with `others` set to a list of
+# (text, meta, html) for each of `versions`. each version is fetched with a single query
+# over runs of consecutive ordinals (or sliced from the verse store), so this costs
+# the same for every additional version.
+def add_other_versions(db, keys, verses, versions):
+    i = keys.index('ordinal')
+    ordinals = [verse[i] for verse in verses]
+    found = [fetch_version_ranges(db, version, merge_ranges(zip(ordinals, ordinals)))
+             for version in versions]
+    missing = (None, None, None)
+    rows = []
+    for ordinal, verse in zip(ordinals, verses):
+        row = Row(zip(keys, verse))
+        row['others'] = [texts.get(ordinal, missing) for texts in found]
+        rows.append(row)
+    return rows
+
+# returns a sorted list of ordinals which may contain all keywords (as per `bibledata`),
+# or None if the keywords have no indexable terms and every row should be checked.
+def find_candidate_ordinals(db, version, keywords):
+    candidates = None
+    for keyword in keywords:
+        for exact, term in bibledata.keyword_terms(keyword):
+            if exact:
+                rows = db.execute('select ordinals from searchterms where version=? and term=?;',
+                                  (version, term))
+            elif len(term) > 1:
+                rows = db.execute('select ordinals from searchterms where version=? and term in '
+                                  '(select term from searchsuffixes '
+                                  'where version=? and suffix>=? and suffix<?);',
+                                  (version, version, term, bibledata.prefix_upper_bound(term)))
+            else:
+                # most words contain a given letter, so scanning terms is cheaper than suffixes
+                rows = db.execute('select ordinals from searchterms where version=? and term like ?;',
+                                  (version, u'%%%s%%' % term))
+            ordinals = set()
+            for row in rows:
+                ordinals.update(bibledata.unpack_ordinals(row['ordinals']))
+            candidates = ordinals if candidates is None else candidates & ordinals
+            if not candidates: return []
+    return None if candidates is None else sorted(candidates)
+
+# an equivalent of `execute_verses_query` (without `where`), where texts of each version
+# are fetched at once with `fetch_version_ranges`
+def fetch_verses_by_ranges(db, versions, cursor=None, ranges=(), count=100):
+    inverted = cursor is not None and cursor < 0
+
+    # merge overlapping ranges and apply the cursor
+    merged = []
+    for minordinal, maxordinal in sorted(ranges):
+        if cursor is None:
+            pass
+        elif cursor >= 0:
+            minordinal = max(minordinal, cursor)
+        else:
+            maxordinal = min(maxordinal, ~cursor)
+        minordinal = max(minordinal, 0)
+        maxordinal = min(maxordinal, mappings.numordinals - 1)
+        if minordinal > maxordinal: continue
+        if merged and merged[-1][1] + 1 >= minordinal:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], maxordinal))
+        else:
+            merged.append((minordinal, maxordinal))
+    if inverted: merged.reverse()
+
+    # every ordinal in ranges results in a row, so ranges can be cut to `count` in advance
+    selected = []
+    remaining = count
+    for minordinal, maxordinal in merged:
+        if count:
+            if inverted:
+                minordinal = max(minordinal, maxordinal - remaining + 1)
+            else:
+                maxordinal = min(maxordinal, minordinal + remaining - 1)
+            remaining -= maxordinal - minordinal + 1
+        selected.append((minordinal, maxordinal))
+        if count and remaining <= 0: break
+    if inverted: selected.reverse()
+
+    found = [fetch_version_ranges(db, version, selected) for version in versions]
+    return list(build_verse_rows(selected, found))
+
+# the number of ordinals fetched at once by `iter_verses_by_ranges`
+STREAM_FETCH_SIZE = 500
+
+# yields the same rows to `execute_verses_query(ranges=ranges, count=None)` without a cursor,
+# but fetches them in pieces while being iterated, so that long ranges can be streamed with
+# a bounded memory. a connection is only held while fetching each piece.
+def iter_verses_by_ranges(versions, ranges):
+    for minordinal, maxordinal in merge_ranges(ranges):
+        minordinal = max(minordinal, 0)
+        maxordinal = min(maxordinal, mappings.numordinals - 1)
+        for start in xrange(minordinal, maxordinal + 1, STREAM_FETCH_SIZE):
+            piece = [(start, min(start + STREAM_FETCH_SIZE - 1, maxordinal))]
+            with database() as db:
+                found = [fetch_version_ranges(db, version, piece) for version in versions]
+            for row in build_verse_rows(piece, found): yield row
+
+# yields rows for every ordinal in sorted `ranges`, where `found` is a list of dicts returned
+# by `fetch_version_ranges` for each version
+def build_verse_rows(ranges, found):
+    missing = (None, None, None)
+    chapters = mappings.chapters
+    for minordinal, maxordinal in ranges:
+        i = chapters.find_chapter(minordinal) - 1
+        nextordinal = minordinal
+        for ordinal in xrange(minordinal, maxordinal + 1):
+            while ordinal >= nextordinal:
+                i += 1
+                _, book, chapter, deltaindex, deltaordinal = chapters.chapter_at(i)
+                nextordinal = chapters.chapter_at(i + 1)[0]
+            verse = ordinal - deltaordinal
+            row = Row(book=book, chapter=chapter, verse=verse, index=deltaindex + verse,
+                      ordinal=ordinal)
+            texts = [rows.get(ordinal, missing) for rows in found]
+            row['text'], row['meta'], row['html'] = texts[0]
+            if len(texts) > 1: row['others'] = texts[1:]
+            yield row
+
+# returns a dict of ordinal to (text, meta, html) for the verses of given version within
+# `ranges`, which are taken from `verse_cache` and otherwise sliced from the verse store
+# or fetched with a single query. (the cache is still cheaper than slicing the store.)
+def fetch_version_ranges(db, version, ranges):
+    found = {}
+    if not ranges: return found
+
+    # only ordinals not in `verse_cache` are read, in runs of consecutive ordinals
+    keyprefix = db.generation, str(version)
+    uncached = []
+    for minordinal, maxordinal in ranges:
+        for ordinal in xrange(max(minordinal, 0), min(maxordinal, mappings.numordinals - 1) + 1):
+            row = verse_cache.get(keyprefix + (ordinal,))
+            if row is None:
+                uncached.append(ordinal)
+            elif row:
+                found[ordinal] = row
+    if not uncached: return found
+    uncached = merge_ranges(zip(uncached, uncached))
+
+    store = mappings.verse_stores.get(str(version))
+    if store is not None:
+        for minordinal, maxordinal in uncached:
+            rows = store.slice(minordinal, maxordinal)
+            for ordinal, row in itertools.izip(xrange(minordinal, maxordinal + 1), rows):
+                verse_cache.put(keyprefix + (ordinal,), row or ())
+                if row is not None: found[ordinal] = row
+        return found
+
+    # plain tuples are much cheaper than `Entry` here
+    cursor = db.cursor()
+    cursor.row_factory = None
+    cursor.execute('''
+        select ordinal, expand(version, "text"), meta, expand(version, coalesce(html, "text"))
+        from data
+        where version=? and (''' + ' or '.join(['ordinal between ? and ?'] * len(uncached)) + ''');
+    ''', (version,) + tuple(ordinal for minmax in uncached for ordinal in minmax))
+    for row in cursor:
+        found[row[0]] = row[1:]
+    for minordinal, maxordinal in uncached:
+        for ordinal in xrange(minordinal, maxordinal + 1):
+            verse_cache.put(keyprefix + (ordinal,), found.get(ordinal, ()))
+    return found
+
+def merge_ranges(ranges):
+    merged = []
+    for minordinal, maxordinal in sorted(ranges):
+        if merged and merged[-1][1] + 1 >= minordinal:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], maxordinal))
+        else:
+            merged.append((minordinal, maxordinal))
+    return merged
+
 def adjust_for_cursor(verses, cursor, count):
     excess = count and len(verses) > count
     if cursor is None:
@@ -543,13 +1430,23 @@ def adjust_for_cursor(verses, cursor, count):
     return prevc, verses, nextc
 
 def get_verses_unbounded(db, where='1', args=(), count=100, **kwargs):
-    verses = execute_verses_query(db, g.cursor, where=where, args=args,
-            count=count+1 if count else None, **kwargs)
+    with timing('sql'):
+        verses = execute_verses_query(db, g.cursor, where=where, args=args,
+                count=count+1 if count else None, **kwargs)
     return adjust_for_cursor(verses, g.cursor, count)
 
+# same to `get_verses_unbounded(db, count=None, ranges=ranges)`, but returns an iterator
+# of verses for `stream_verses` unless a cursor is given (see `iter_verses_by_ranges`)
+def get_verses_streamed(ranges):
+    if g.cursor is not None:
+        with database() as db:
+            return get_verses_unbounded(db, count=None, ranges=ranges)
+    return None, iter_verses_by_ranges(g.versions, ranges), None
+
 def get_verses_bounded(db, minordinal, maxordinal, where='1', args=(), count=100, **kwargs):
-    verses = execute_verses_query(db, g.cursor, where=where, args=args,
-            count=count+2 if count else None, **kwargs)
+    with timing('sql'):
+        verses = execute_verses_query(db, g.cursor, where=where, args=args,
+                count=count+2 if count else None, **kwargs)
 
     smaller = []
     inrange = []
@@ -580,6 +1477,9 @@ def get_verses_bounded(db, minordinal, maxordinal, where='1', args=(), count=100
 @app.route('/')
 def index():
     today = datetime.date.today()
+    return dated_page(lambda: do_index(today), today)
+
+def do_index(today):
     daily = mappings.get_recent_daily('%02d-%02d' % (today.month, today.day))
     return render_template('index.html', query=u'', books=mappings.books, daily=daily)
 
@@ -587,6 +1487,107 @@ def index():
 def about():
     return render_template('about.html', query=u'')
 
+@app.route('/+/metrics')
+def metrics():
+    if not app.config['TIMING']: abort(404)
+    return route_metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# a reference is a book optionally followed by a chapter and a verse, and optionally
+# followed by the end of range, which may be in other book (e.g. "John 3:16-18",
+# "Gen/50-Exod/2.3", "요한일서 1-3", "Ps 119", "Matt-John").
+REFERENCE_PATTERN = re.compile(ur'(?u)^\s*(?P<book1>.+?)[\s/]*'
+                               ur'(?:(?P<chapter1>\d+)(?:\s*[.:]\s*(?P<verse1>\d+))?)?\s*'
+                               ur'(?:(?P<range>[-~])\s*(?:(?P<book2>\d*\s*[^\W\d_]\D*?)[\s/]*)?'
+                                   ur'(?:(?P<chapter2>\d+)(?:\s*[.:]\s*(?P<verse2>\d+))?)?)?\s*$')
+
+# returns a pair of triples for given reference or raises ValueError
+def resolve_reference(ref):
+    m = REFERENCE_PATTERN.match(ref)
+    if not m: raise ValueError('invalid reference')
+    book1, chapter1, verse1, book2, chapter2, verse2 = \
+            m.group('book1', 'chapter1', 'verse1', 'book2', 'chapter2', 'verse2')
+    try:
+        book1 = mappings.find_book_by_alias(book1).book
+        book2 = mappings.find_book_by_alias(book2).book if book2 else None
+    except KeyError:
+        raise ValueError('invalid book')
+    chapter1, verse1, chapter2, verse2 = [int(n) if n else None
+                                          for n in (chapter1, verse1, chapter2, verse2)]
+
+    start = triple(book1, chapter1 or 0, verse1 or 0)
+    if not m.group('range'):
+        end = triple(book1, chapter1 or '$', verse1 or '$')
+    elif book2 is None and verse1 is not None and chapter2 is not None and verse2 is None:
+        end = triple(book1, chapter1, chapter2) # "John 3:16-18"
+    else:
+        end = triple(book2 if book2 is not None else book1, chapter2 or '$', verse2 or '$')
+    if start.ordinal > end.ordinal: start, end = end, start
+    return start, end
+
+# resolves many references at once, e.g. /+/api/verses?r=John+3:16&r=Gen+50-Exod+2&v=kjv,kjav.
+# POST requests may have a JSON object like {"refs": [...], "versions": [...]} instead.
+@app.route('/+/api/verses', methods=['GET', 'POST'])
+def api_verses():
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    if isinstance(body, dict):
+        refs = body.get('refs', [])
+        versions = body.get('versions', [])
+    elif body is None:
+        refs = request.args.getlist('r')
+        versions = [v for v in request.args.get('v', u'').split(',') if v]
+    else:
+        return jsonify(error='invalid request'), 400
+    if not isinstance(refs, list) or not all(isinstance(ref, basestring) for ref in refs) or \
+            not isinstance(versions, list) or \
+            not all(isinstance(v, basestring) for v in versions):
+        return jsonify(error='invalid request'), 400
+    if len(refs) > app.config['API_MAX_REFERENCES']:
+        return jsonify(error='too many references'), 400
+    try:
+        versions = [mappings.find_version_by_alias(v) for v in versions] or \
+                   [mappings.versions[mappings.DEFAULT_VER]]
+    except Exception:
+        return jsonify(error='invalid version'), 400
+
+    results = []
+    ranges = []
+    for ref in refs:
+        try:
+            start, end = resolve_reference(unicode(ref))
+        except ValueError as e:
+            results.append({'ref': ref, 'error': str(e)})
+            continue
+        results.append({'ref': ref, 'start': start, 'end': end})
+        ranges.append((start.ordinal, end.ordinal))
+    if sum(maxordinal - minordinal + 1 for minordinal, maxordinal in ranges) > \
+            app.config['API_MAX_VERSES']:
+        return jsonify(error='too many verses'), 400
+
+    merged = merge_ranges(ranges)
+    with database() as db:
+        found = [fetch_version_ranges(db, version, merged) for version in versions]
+
+    def position(t):
+        return {'book': mappings.books[t.book].code, 'chapter': t.chapter, 'verse': t.verse}
+    for result in results:
+        if 'error' in result: continue
+        start = result['start']
+        end = result['end']
+        verses = []
+        for ordinal in xrange(start.ordinal, end.ordinal + 1):
+            book, chapter, verse = mappings.locate(ordinal)
+            entry = {'book': mappings.books[book].code, 'chapter': chapter, 'verse': verse,
+                     'ordinal': ordinal}
+            for version, rows in zip(versions, found):
+                row = rows.get(ordinal)
+                entry[version.version] = {'text': row[0], 'html': row[2]} if row else None
+            verses.append(entry)
+        result['start'] = position(start)
+        result['end'] = position(end)
+        result['verses'] = verses
+
+    return jsonify(versions=[version.version for version in versions], results=results)
+
 @app.route('/+/daily/')
 @app.route('/+/daily/<code>')
 def daily(code=None):
@@ -603,21 +1604,43 @@ def daily(code=None):
 
     daily = mappings.get_recent_daily(actualcode)
     if daily.code != code:
-        return redirect(url_for('.daily', code=daily.code))
-    with database() as db:
-        where = ' and '.join(['(v.ordinal between ? and ?)'] * len(daily.ranges))
-        args = tuple(bcv.ordinal for start_end in daily.ranges for bcv in start_end)
-        verses_and_cursors = get_verses_unbounded(db, where, args, count=None)
+        response = redirect(url_for('.daily', code=daily.code))
+        if code is None: response.cache_control.max_age = seconds_until_tomorrow()
+        return response
+    return cached_stream(lambda: do_daily(daily), daily.code)
+
+def do_daily(daily):
+    ranges = [(start.ordinal, end.ordinal) for start, end in daily.ranges]
+    verses_and_cursors = get_verses_streamed(ranges)
 
     query = u'' # XXX
-    return render_verses('daily.html', verses_and_cursors, query=query, daily=daily)
+    return stream_verses('daily.html', verses_and_cursors, query=query, daily=daily)
+
+@app.route('/+/plan/<kind>/<code>')
+def plan(kind, code):
+    if kind == 'daily': return redirect(url_for('.daily', code=code))
+    index = mappings.find_plan_day(kind, code)
+    if index is None: abort(404)
+
+    normalize_url('.plan', kind=kind, code=code)
+    day = PlanDay(mappings, kind, index)
+    return cached_stream(lambda: do_plan(day), kind, code)
+
+def do_plan(day):
+    ranges = [(start.ordinal, end.ordinal) for start, end in day.ranges]
+    verses_and_cursors = get_verses_streamed(ranges)
+
+    return stream_verses('plan.html', verses_and_cursors, query=u'', day=day)
 
 @app.route('/+/daily/list')
 def daily_list():
     today = datetime.date.today()
+    return dated_page(lambda: do_daily_list(today), today)
+
+def do_daily_list(today):
     daily = mappings.get_recent_daily('%02d-%02d' % (today.month, today.day))
-    dailylist = map(Daily, xrange(len(mappings.dailyranges)))
-    return render_template('daily_list.html', query=u'', daily=daily, dailylist=dailylist)
+    return render_template('daily_list.html', query=u'', daily=daily,
+                           dailylist=mappings.get_dailies())
 
 @app.route('/search')
 def search():
@@ -702,24 +1725,25 @@ def search():
             start = 0
             while start < len(unquoted):
                 s = u''
+                # the shortest book or (blessed) version alias is taken, books first.
                 # avoid quadratic complexity, no token is more than 5 words long
+                node = mappings.aliastrie
                 for i in xrange(start, min(start+5, len(unquoted))):
-                    s += unquoted[i]
-                    try:
-                        book, lang = mappings.find_book_and_lang_by_alias(s)
+                    s += unquoted[i] # `s` is also used for the implied language below
+                    if node is None: continue
+                    for ch in mappings.normalize(unquoted[i]):
+                        node = node.get(ch)
+                        if node is None: break
+                    if node is None: continue
+                    if 'book' in node:
                         tokens.append(('book', s))
                         start = i + 1
                         break
-                    except KeyError:
-                        pass
-                    try:
-                        version = mappings.find_version_by_alias(s)
-                        if version.blessed: # TODO temporary
-                            tokens.append(('version',s))
-                            start = i + 1
-                            break
-                    except KeyError:
-                        pass
+                    version = node.get('version')
+                    if version is not None and version.blessed: # TODO temporary
+                        tokens.append(('version',s))
+                        start = i + 1
+                        break
                 else:
                     if unquoted[start].isdigit():
                         tokens.append(('range', (int(unquoted[start]), None, None, None)))
@@ -757,7 +1781,7 @@ def search():
     else:
         implied_lang = None # unknown or ambiguous
 
-    old_version = g.version1, g.version2
+    old_versions = list(g.versions)
     if 'version' in tagged:
         versions = []
         seen = set()
@@ -771,15 +1795,13 @@ def search():
             except KeyError:
                 pass
 
-        g.version1 = versions[0] if len(versions) > 0 else None
-        g.version2 = versions[1] if len(versions) > 1 else None
-        # TODO version3 and later
+        if versions: g.versions = versions
     else:
         # if there is no other version hint but an implied lang, use it
         if not request.args.get('v') and implied_lang:
-            g.version1 = mappings.versions[mappings.DEFAULT_VER_PER_LANG[implied_lang]]
+            g.versions = [mappings.versions[mappings.DEFAULT_VER_PER_LANG[implied_lang]]]
 
-    version_updated = (g.version1, g.version2) != old_version
+    version_updated = g.versions != old_versions
 
     if 'book' in tagged:
         books = []
@@ -831,10 +1853,16 @@ def search():
     if version_updated:
         return redirect(url_for('.search') + build_query_suffix(q=query, _searching=True))
 
+    # search results are not cached, but identified in the same way
+    g.keywords = keywords
+    check_etag(page_key((query,)))
+
     with database() as db:
+        with timing('sql'):
+            ordinals = find_candidate_ordinals(db, g.versions[0], keywords)
         verses_and_cursors = get_verses_unbounded(db,
-                ' and '.join(['d."text" like ?'] * len(keywords)),
-                tuple('%%%s%%' % keyword for keyword in keywords))
+                ' and '.join(['expand(d.version, d."text") like ?'] * len(keywords)),
+                tuple('%%%s%%' % keyword for keyword in keywords), ordinals=ordinals)
 
     return render_verses('search.html', verses_and_cursors, query=query, keywords=keywords)
 
@@ -852,13 +1880,8 @@ def view_chapter(book, chapter):
     except Exception:
         abort(404)
 
-    with database() as db:
-        prev, verses_and_cursors, next = get_verses_bounded(db, start.ordinal, end.ordinal,
-                'v.ordinal between ? and ?', (start.ordinal-1, end.ordinal+1))
-
     query = u'%s %d' % (book.abbr_ko, start.chapter)
-    return render_verses('chapters.html', verses_and_cursors, query=query, prev=prev, next=next,
-                         book=book, chapter1=start.chapter, chapter2=end.chapter)
+    return cached_page(lambda: do_view_chapters(book, start, end, query), start.ordinal)
 
 @app.route('/<book:book>/<int_or_end:chapter1>-<int_or_end:chapter2>')
 def view_chapters(book, chapter1, chapter2):
@@ -871,26 +1894,35 @@ def view_chapters(book, chapter1, chapter2):
     if start.ordinal > end.ordinal:
         return redirect(url_for('.view_chapters', book=book, chapter1=chapter2, chapter2=chapter1))
 
+    query = u'%s %d-%d' % (book.abbr_ko, start.chapter, end.chapter)
+    return cached_stream(lambda: do_view_chapters(book, start, end, query, stream_verses),
+                         start.ordinal, end.ordinal)
+
+def do_view_chapters(book, start, end, query, render=render_verses):
     with database() as db:
         prev, verses_and_cursors, next = get_verses_bounded(db, start.ordinal, end.ordinal,
-                'v.ordinal between ? and ?', (start.ordinal-1, end.ordinal+1))
+                ranges=[(start.ordinal-1, end.ordinal+1)])
 
-    query = u'%s %d-%d' % (book.abbr_ko, start.chapter, end.chapter)
-    return render_verses('chapters.html', verses_and_cursors, query=query, prev=prev, next=next,
-                         book=book, chapter1=start.chapter, chapter2=end.chapter)
+    return render('chapters.html', verses_and_cursors, query=query, prev=prev, next=next,
+                  book=book, chapter1=start.chapter, chapter2=end.chapter,
+                  plans=mappings.find_plans(start.ordinal, end.ordinal))
 
 def do_view_verses(book, start, end, query):
     bcv1 = (start.book, start.chapter, start.verse)
     bcv2 = (end.book, end.chapter, end.verse)
     highlight = lambda b,c,v: bcv1 <= (b,c,v) <= bcv2
 
+    # ordinals and indices differ by a constant in the same book
+    minordinal = start.ordinal - start.index
+    maxordinal = triple(book.book, '$', '$').ordinal
     with database() as db:
-        verses_and_cursors = get_verses_unbounded(db, 'v.book=? and v."index" between ? and ?',
-                (book.book, start.index-5, end.index+5))
+        verses_and_cursors = get_verses_unbounded(db,
+                ranges=[(max(start.ordinal-5, minordinal), min(end.ordinal+5, maxordinal))])
 
     return render_verses('verses.html', verses_and_cursors, query=query, highlight=highlight,
                          book=book, chapter1=start.chapter, verse1=start.verse,
-                         chapter2=end.chapter, verse2=end.verse)
+                         chapter2=end.chapter, verse2=end.verse,
+                         plans=mappings.find_plans(start.ordinal, end.ordinal))
 
 @app.route('/<book:book>/<int_or_end:chapter>.<int_or_end:verse>')
 def view_verse(book, chapter, verse):
@@ -900,7 +1932,7 @@ def view_verse(book, chapter, verse):
     except Exception:
         abort(404)
     query = u'%s %d:%d' % (book.abbr_ko, start.chapter, start.verse)
-    return do_view_verses(book, start, end, query)
+    return cached_page(lambda: do_view_verses(book, start, end, query), start.ordinal)
 
 @app.route('/<book:book>/<int_or_end:chapter1>.<int_or_end:verse1>-<int_or_end:chapter2>.<int_or_end:verse2>')
 def view_verses(book, chapter1, verse1, chapter2, verse2):
@@ -920,7 +1952,8 @@ def view_verses(book, chapter1, verse1, chapter2, verse2):
     else:
         query = u'%s %d:%d-%d:%d' % (book.abbr_ko, start.chapter, start.verse,
                                      end.chapter, end.verse)
-    return do_view_verses(book, start, end, query)
+    return cached_page(lambda: do_view_verses(book, start, end, query),
+                       start.ordinal, end.ordinal)
 
 @app.before_request
 def compile_less():
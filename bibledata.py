@@ -0,0 +1,674 @@
+# coding=utf-8
+# data formats shared by populate.py (which writes them) and bible.py (which reads them).
+import os
+import re
+import sys
+import mmap
+import zlib
+import ctypes
+import struct
+import marshal
+import itertools
+import sqlite3
+from array import array
+from jinja2.utils import Markup
+
+# search index
+#
+# every `data` row is indexed by a set of terms, kept in the `searchterms` table as
+# a packed list of ordinals per (version, term). scripts without word separators
+# (Hangul, CJK ideographs) are indexed as character unigrams and bigrams, others as
+# lowercased words. the index only narrows the candidates down; the exact keyword
+# semantics (`d."text" like '%keyword%'`) are still checked against the candidates.
+# every suffix of a word is kept in `searchsuffixes`, so that words containing a term
+# can be found with a range scan over suffixes starting with the term.
+
+NGRAM_CHARS = u'\u1100-\u11ff\u3130-\u318f\uac00-\ud7a3\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+NGRAM_RUN_PATTERN = re.compile(u'[%s]+' % NGRAM_CHARS, re.U)
+# `_` is excluded so that wildcards in keywords always separate terms
+TERM_RUN_PATTERN = re.compile(u'[%s]+|[^\\W_%s]+' % (NGRAM_CHARS, NGRAM_CHARS), re.U)
+
+def index_terms(text):
+    terms = set()
+    for run in TERM_RUN_PATTERN.findall(text.lower()):
+        if NGRAM_RUN_PATTERN.match(run):
+            terms.update(run)
+            terms.update(run[i:i+2] for i in xrange(len(run)-1))
+        else:
+            terms.add(run)
+    return terms
+
+# returns a list of (exact, term) pairs that should *all* be satisfied by any row
+# containing the keyword. an exact term should be in the index as is; otherwise
+# any indexed word containing the term would do.
+def keyword_terms(keyword):
+    terms = []
+    for run in TERM_RUN_PATTERN.findall(keyword.lower()):
+        if NGRAM_RUN_PATTERN.match(run):
+            if len(run) == 1:
+                terms.append((True, run))
+            else:
+                terms.extend((True, run[i:i+2]) for i in xrange(len(run)-1))
+        else:
+            terms.append((False, run))
+    return terms
+
+# suffixes of a word term to be kept in `searchsuffixes`; n-gram terms have none,
+# as they are always looked up exactly
+def term_suffixes(term):
+    if NGRAM_RUN_PATTERN.match(term): return []
+    return [term[i:] for i in xrange(len(term))]
+
+# the smallest string greater than every string starting with `prefix`
+def prefix_upper_bound(prefix):
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+# ordinals are stored as little-endian 32-bit integers
+def pack_ordinals(ordinals):
+    ordinals = array('i', ordinals)
+    if sys.byteorder != 'little': ordinals.byteswap()
+    return buffer(ordinals.tostring())
+
+def unpack_ordinals(packed):
+    ordinals = array('i')
+    ordinals.fromstring(bytes(packed))
+    if sys.byteorder != 'little': ordinals.byteswap()
+    return ordinals
+
+# verse rendering
+#
+# `data` rows have the plain text and a `meta` blob for the markup. populate.py renders
+# them to the `html` column in advance (without keywords), so that bible.py only has to
+# call this when keywords should be highlighted.
+
+# finds all (possibly overlapping) occurrences of multiple keywords in a single pass
+# with the Aho-Corasick automaton. keywords are case-insensitive and earlier ones take
+# precedence over later ones when they overlap.
+class KeywordMatcher(object):
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+        self.lowered = [keyword.lower() for keyword in self.keywords]
+
+        # trie of keywords; `outputs` has (keyword index, length) pairs ending at each state
+        goto = [{}]
+        outputs = [[]]
+        for k, keyword in enumerate(self.lowered):
+            if not keyword: continue
+            state = 0
+            for ch in keyword:
+                if ch not in goto[state]:
+                    goto[state][ch] = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                state = goto[state][ch]
+            outputs[state].append((k, len(keyword)))
+
+        # turn the trie into a DFA by resolving failure links in the BFS order.
+        # characters not in `transitions[state]` go back to the initial state.
+        fail = [0] * len(goto)
+        transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = list(goto[0].values())
+        for state in queue:
+            transitions[state] = dict(transitions[fail[state]])
+            transitions[state].update(goto[state])
+            outputs[state] = outputs[state] + outputs[fail[state]]
+            for ch, next in goto[state].items():
+                fail[next] = transitions[fail[state]].get(ch, 0)
+                queue.append(next)
+        self.transitions = transitions
+        self.outputs = outputs
+
+    # a quick check for whether `spans` can ever return anything
+    def occurs_in(self, slower):
+        return any(keyword and keyword in slower for keyword in self.lowered)
+
+    # returns a sorted list of non-overlapping (start, end, keyword index) spans
+    def spans(self, slower):
+        transitions = self.transitions
+        outputs = self.outputs
+        events = []
+        state = 0
+        for i, ch in enumerate(slower):
+            state = transitions[state].get(ch, 0)
+            if outputs[state]:
+                for k, length in outputs[state]:
+                    events.append((i + 1 - length, 1, k))
+                    events.append((i + 1, -1, k))
+        if not events: return []
+
+        # sweep over the events, keeping the highest priority keyword among active ones
+        events.sort()
+        active = {}
+        spans = []
+        prev = None # (start, keyword index)
+        for pos, delta, k in events:
+            active[k] = active.get(k, 0) + delta
+            if not active[k]: del active[k]
+            mark = min(active) if active else None
+            if prev and prev[1] == mark: continue
+            if prev and prev[0] < pos: spans.append((prev[0], pos, prev[1]))
+            prev = (pos, mark) if mark is not None else None
+        return spans
+
+# `meta` describes styles of the text and annotations placed between characters. styles:
+#     0 -- normal
+#     1 -- italicized (artificial text in KJV)
+#     2 -- Capitalized
+#     3 -- UPPERCASED
+#
+# there are two formats, told apart by the first byte. the span format is written by
+# populate.py, and starts with \xfe which the flag format never starts with:
+#
+# - \xfe, the format version (\1), the number of runs R and anchors A (uint16 each)
+# - R runs of (start, length, style) as uint16, uint16, uint8, for non-normal styles only
+# - A offsets (uint16) of annotations in the text, in the increasing order
+# - A annotations in UTF-8, separated by \xff
+#
+# the flag format (in older databases) is a flag byte per character (plus optionally one
+# more for the end of text), followed by annotations, all separated by \xff. flags:
+# * 127 (bit mask) -- style
+# * 128 (bit mask) -- will fetch the annotation from the extra *before* this
+# * 255 -- separators for markup
+#
+# all integers are little-endian.
+STYLE_OPENING = ('', '<i>', '<em>', '<strong>', '<small>')
+STYLE_CLOSING = ('', '</i>', '</em>', '</strong>', '</small>')
+STYLE_FLAGS = ''.join(chr(i & 127) for i in xrange(256))
+STYLE_RUN_PATTERN = re.compile(r'(.)\1*', re.S)
+ANNOTATION_PATTERN = re.compile(r'[\x80-\xfe]')
+
+META_SPANS = '\xfe'
+META_VERSION = '\1'
+META_HEADER = struct.Struct('<ccHH')
+
+# `runs` is a list of (start, length, style) for non-normal styles, `annotations` is a list of
+# (offset, annotation) and both should be sorted
+def encode_meta(runs, annotations):
+    return (META_HEADER.pack(META_SPANS, META_VERSION, len(runs), len(annotations)) +
+            struct.pack('<' + 'HHB' * len(runs), *[v for run in runs for v in run]) +
+            struct.pack('<%dH' % len(annotations), *[offset for offset, _ in annotations]) +
+            '\xff'.join(annotation.encode('utf-8') for _, annotation in annotations))
+
+# returns a list of (start, end, style) covering the whole text of `length` characters,
+# and a dict from offsets to annotations
+def decode_meta(meta, length):
+    meta = bytes(meta)
+    if meta[:1] != META_SPANS: return decode_flag_meta(meta, length)
+
+    _, version, nruns, nannotations = META_HEADER.unpack_from(meta)
+    if version != META_VERSION: raise ValueError('unknown meta format %r' % version)
+    pos = META_HEADER.size
+    runs = struct.unpack_from('<' + 'HHB' * nruns, meta, pos)
+    pos += 5 * nruns
+    offsets = struct.unpack_from('<%dH' % nannotations, meta, pos)
+    pos += 2 * nannotations
+    annotations = {}
+    if offsets:
+        for offset, annotation in zip(offsets, meta[pos:].split('\xff')):
+            annotations[offset] = annotation.decode('utf-8')
+
+    styles = []
+    end = 0
+    for i in xrange(0, len(runs), 3):
+        start, runlength, style = runs[i:i+3]
+        if end < start: styles.append((end, start, 0))
+        end = start + runlength
+        styles.append((start, end, style))
+    if end < length: styles.append((end, length, 0))
+    return styles, annotations
+
+def decode_flag_meta(meta, length):
+    extra = meta.split('\xff')
+    markup = extra[0]
+    assert len(markup) == length or len(markup) == length + 1
+    if len(markup) > length: # there are length+1 positions where annotated text can go
+        assert (ord(markup[-1]) & 127) == 0 # annotated text only
+    annotations = {}
+    for i, m in enumerate(ANNOTATION_PATTERN.finditer(markup)):
+        annotations[m.start()] = extra[i+1].decode('utf-8')
+    styles = [(m.start(), m.end(), ord(m.group(1)))
+              for m in STYLE_RUN_PATTERN.finditer(markup[:length].translate(STYLE_FLAGS))]
+    return styles, annotations
+
+# renders the text with the markup in `meta` and keywords matched by `matcher` if any.
+def render_htmltext(s, meta=None, matcher=None):
+    if not s: return u''
+
+    # the text is processed in segments, and every segment has the same style and mark.
+    # `styles` and `marks` are lists of (start, end, value) and only differ in that
+    # `styles` covers the whole text.
+    if meta is not None:
+        styles, annotations = decode_meta(meta, len(s))
+    else:
+        styles = [(0, len(s), 0)]
+        annotations = {}
+    marks = matcher.spans(s.lower()) if matcher else []
+
+    bounds = set(annotations)
+    bounds.update(start for start, _, _ in styles)
+    bounds.update(start for start, _, _ in marks)
+    bounds.update(end for _, end, _ in marks)
+    bounds.add(len(s))
+    bounds = sorted(bounds)
+
+    ss = []
+    prevstyle = 0
+    prevmark = None
+    istyle = 0
+    imark = 0
+    for pos, nextpos in zip(bounds, bounds[1:] + [None]):
+        if pos in annotations:
+            ss.append(u'<small>%s</small>' % Markup.escape(annotations[pos]))
+
+        if nextpos is None: # past the end of text
+            style = 0
+            mark = None
+        else:
+            while styles[istyle][1] <= pos: istyle += 1
+            style = styles[istyle][2]
+            while imark < len(marks) and marks[imark][1] <= pos: imark += 1
+            if imark < len(marks) and marks[imark][0] <= pos:
+                mark = marks[imark][2]
+            else:
+                mark = None
+
+        if (style, mark) != (prevstyle, prevmark):
+            closing = []
+            opening = []
+
+            cascade = False
+            if cascade or mark != prevmark:
+                if prevmark is not None: closing.append(u'</mark>')
+                if mark is not None: opening.append(u'<mark class="keyword%d">' % mark)
+                cascade = True
+            if cascade or style != prevstyle:
+                if prevstyle: closing.append(STYLE_CLOSING[prevstyle])
+                if style: opening.append(STYLE_OPENING[style])
+                cascade = True
+
+            prevstyle = style
+            prevmark = mark
+            ss.extend(closing[::-1])
+            ss.extend(opening)
+
+        if nextpos is not None:
+            ss.append(Markup.escape(s[pos:nextpos]))
+
+    return Markup(u''.join(ss))
+
+# columnar verse store
+#
+# populate.py also writes each version of `data` into a separate file, so that a range of
+# ordinals can be sliced out of a memory mapping (shared by all processes through the page
+# cache) without going through SQLite. the layout (integers are little-endian uint32):
+#
+# - the magic, the generation of database it was written with, and the number of ordinals N
+# - N presence flags, one byte each (\1 if the version has that ordinal), padded to 4 bytes
+# - N+1 offsets to the text, meta and html column each, relative to the start of data,
+#   where offsets to the text and html are followed by N+1 offsets in characters as well
+# - data, that is, every text then every meta then every html (text and html in UTF-8)
+#
+# character offsets let a range of texts be decoded at once and then cut into verses.
+# meta and html are null when empty; the html is then the text itself. stores of unchanged
+# versions are kept by incremental updates, so the database records the generation of
+# the valid store for each version in the `versestores` table.
+
+STORE_MAGIC = 'BVSTORE3'
+STORE_HEADER = struct.Struct('<8sII')
+# whether each column is a text (and has character offsets)
+STORE_TEXTS = (True, False, True)
+STORE_NUM_OFFSETS = len(STORE_TEXTS) + sum(STORE_TEXTS)
+
+def verse_store_path(dbpath, version):
+    base, _ = os.path.splitext(dbpath)
+    return '%s-%s.verses' % (base, version)
+
+# `rows` is a list of (ordinal, text, meta, html)
+def write_verse_store(path, generation, count, rows):
+    rows = dict((row[0], row[1:]) for row in rows)
+    presence = bytearray(count + (-count) % 4)
+    for ordinal in rows: presence[ordinal] = 1
+
+    offsets = array('I')
+    data = []
+    size = 0
+    for column, text in enumerate(STORE_TEXTS):
+        values = []
+        for ordinal in xrange(count):
+            value = rows[ordinal][column] if ordinal in rows else None
+            if value is None:
+                value = u'' if text else ''
+            elif not text:
+                value = bytes(value)
+            values.append(value)
+        if text:
+            encoded = [value.encode('utf-8') for value in values]
+        else:
+            encoded = values
+        for value in encoded:
+            offsets.append(size)
+            data.append(value)
+            size += len(value)
+        offsets.append(size)
+        if text:
+            length = 0
+            for value in values:
+                offsets.append(length)
+                length += len(value)
+            offsets.append(length)
+    if sys.byteorder != 'little': offsets.byteswap()
+
+    with open(path, 'wb') as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, generation, count))
+        f.write(presence)
+        f.write(offsets.tostring())
+        for value in data: f.write(value)
+
+class VerseStore(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self.count = STORE_HEADER.unpack_from(self.map, 0)
+        if magic != STORE_MAGIC:
+            self.map.close()
+            raise ValueError('not a verse store: %s' % path)
+        self.presence = STORE_HEADER.size
+        self.offsets = self.presence + self.count + (-self.count) % 4
+        self.data = self.offsets + STORE_NUM_OFFSETS * (self.count + 1) * 4
+
+    def close(self):
+        self.map.close()
+
+    # returns a list of (text, meta, html) for ordinal1 through ordinal2 (inclusive),
+    # or None for ordinals missing from the version. html is coalesced to the text.
+    def slice(self, ordinal1, ordinal2):
+        ordinal1 = max(ordinal1, 0)
+        ordinal2 = min(ordinal2, self.count - 1)
+        n = ordinal2 - ordinal1 + 1
+        if n <= 0: return []
+
+        # every column is read at once and cut with list comprehensions, which are much
+        # cheaper than slicing and decoding each value out of the mapping
+        fmt = '<%dI' % (n + 1)
+        offsets = [
+            struct.unpack_from(fmt, self.map, self.offsets + (i * (self.count + 1) + ordinal1) * 4)
+            for i in xrange(STORE_NUM_OFFSETS)]
+        texts = self.read_column(offsets[0], offsets[1])
+        metas = [meta or None for meta in self.read_column(offsets[2], offsets[2])]
+        htmls = [html or text
+                 for text, html in itertools.izip(texts, self.read_column(offsets[3], offsets[4]))]
+        rows = zip(texts, metas, htmls)
+
+        presence = self.map[self.presence + ordinal1:self.presence + ordinal2 + 1]
+        if '\0' in presence:
+            rows = [row if flag != '\0' else None for row, flag in itertools.izip(rows, presence)]
+        return rows
+
+    # returns values between consecutive `offsets`, which are cut from a single string at
+    # `cutoffsets` (either the same byte offsets, or character offsets for decoded texts)
+    def read_column(self, offsets, cutoffsets):
+        value = self.map[self.data + offsets[0]:self.data + offsets[-1]]
+        if cutoffsets is not offsets: value = value.decode('utf-8')
+        base = cutoffsets[0]
+        return [value[start - base:end - base]
+                for start, end in itertools.izip(cutoffsets, cutoffsets[1:])]
+
+# chapter table
+#
+# bible.py looks chapters and verses up in a flat table (see `triple` there) rather than in
+# dicts, and populate.py writes it next to the database so that every process shares a single
+# memory mapping of it. the layout (integers are little-endian int32):
+#
+# - the magic, the generation, and the number of books B, slots S, chapters C and ordinals
+# - for each book 0..B-1, (minchapter, maxchapter, slot of minchapter), or (1, 0, 0) if missing
+# - for each slot, (minverse, maxverse, deltaindex, deltaordinal) of a chapter, where
+#   chapters of a book are in consecutive slots and missing chapters are (1, 0, 0, 0)
+# - for each chapter in the order of ordinals, (minordinal, book, chapter, deltaindex,
+#   deltaordinal), followed by (number of ordinals, -1, -1, 0, 0)
+#
+# the table is only valid for the generation of database it was written with.
+
+CHAPTERS_MAGIC = 'BCHAPTB1'
+CHAPTERS_HEADER = struct.Struct('<8siiiii')
+CHAPTERS_BOOK = struct.Struct('<iii')
+CHAPTERS_SLOT = struct.Struct('<iiii')
+CHAPTERS_ORDER = struct.Struct('<iiiii')
+
+def chapter_table_path(dbpath):
+    base, _ = os.path.splitext(dbpath)
+    return base + '.chapters'
+
+# `chapterranges` and `verseranges` are as in the snapshot
+def build_chapter_table(generation, chapterranges, verseranges):
+    numbooks = max(book for book, _, _ in chapterranges) + 1
+    books = [(1, 0, 0)] * numbooks
+    numslots = 0
+    for book, minchapter, maxchapter in sorted(chapterranges):
+        books[book] = (minchapter, maxchapter, numslots)
+        numslots += maxchapter - minchapter + 1
+    slots = [(1, 0, 0, 0)] * numslots
+    order = []
+    for book, chapter, minverse, maxverse, minindex, maxindex, minordinal, maxordinal \
+            in verseranges:
+        assert maxverse - minverse == maxindex - minindex == maxordinal - minordinal
+        minchapter, _, slot = books[book]
+        slots[slot + chapter - minchapter] = \
+                (minverse, maxverse, minindex - minverse, minordinal - minverse)
+        order.append((minordinal, book, chapter, minindex - minverse, minordinal - minverse))
+    order.sort()
+    numordinals = max(row[-1] for row in verseranges) + 1
+    order.append((numordinals, -1, -1, 0, 0))
+
+    return ''.join([CHAPTERS_HEADER.pack(CHAPTERS_MAGIC, generation, numbooks, numslots,
+                                         len(order) - 1, numordinals)] +
+                   [CHAPTERS_BOOK.pack(*row) for row in books] +
+                   [CHAPTERS_SLOT.pack(*row) for row in slots] +
+                   [CHAPTERS_ORDER.pack(*row) for row in order])
+
+# works on a string returned by `build_chapter_table` or a memory mapping of it. every
+# lookup is plain index arithmetic on `ints`, the integers following the magic, except that
+# the ranges of books are also kept in `bookslots` (which is small) for `bible.triple`.
+class ChapterTable(object):
+    def __init__(self, data):
+        magic, self.generation, self.numbooks, self.numslots, self.numchapters, \
+                self.numordinals = CHAPTERS_HEADER.unpack_from(data, 0)
+        if magic != CHAPTERS_MAGIC: raise ValueError('not a chapter table')
+        self.data = data
+        count = (len(data) - len(CHAPTERS_MAGIC)) // 4
+        if isinstance(data, mmap.mmap) and sys.byteorder == 'little':
+            self.ints = (ctypes.c_int32 * count).from_buffer(data, len(CHAPTERS_MAGIC))
+        else:
+            self.ints = array('i', data[len(CHAPTERS_MAGIC):])
+            if sys.byteorder != 'little': self.ints.byteswap()
+        self.books = 5
+        self.slots = self.books + 3 * self.numbooks
+        self.order = self.slots + 4 * self.numslots
+
+        # book: (minchapter, maxchapter, ints, base) for books present, where `ints[base +
+        # 4*chapter:base + 4*chapter + 4]` is (minverse, maxverse, deltaindex, deltaordinal)
+        # of a chapter. `ints` is repeated so that a single lookup gives everything needed.
+        self.bookslots = {}
+        for book in xrange(self.numbooks):
+            i = self.books + 3 * book
+            minchapter, maxchapter, slot = self.ints[i:i+3]
+            if minchapter <= maxchapter:
+                self.bookslots[book] = (minchapter, maxchapter, self.ints,
+                                        self.slots + 4 * (slot - minchapter))
+
+    # the mapping is copy-on-write only for ctypes, which needs a writable buffer;
+    # it is never written, so the pages are still shared through the page cache.
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    def close(self):
+        self.ints = None
+        self.bookslots.clear() # also shared with `bible.triple`
+        if isinstance(self.data, mmap.mmap): self.data.close()
+
+    # everything but the header, which is the same for the same chapters and verses
+    def body(self):
+        return self.data[CHAPTERS_HEADER.size:]
+
+    # returns (minchapter, maxchapter), or None if the book is missing
+    def chapter_range(self, book):
+        slots = self.bookslots.get(book)
+        if slots is None: return None
+        return slots[0], slots[1]
+
+    # returns (minverse, maxverse, deltaindex, deltaordinal), or None if the chapter is missing
+    def verse_range(self, book, chapter):
+        slots = self.bookslots.get(book)
+        if slots is None or not slots[0] <= chapter <= slots[1]: return None
+        i = slots[3] + 4 * chapter
+        minverse, maxverse, deltaindex, deltaordinal = self.ints[i:i+4]
+        if minverse > maxverse: return None
+        return minverse, maxverse, deltaindex, deltaordinal
+
+    # returns (minordinal, book, chapter, deltaindex, deltaordinal) of the i-th chapter
+    # in the order of ordinals; the minordinal for i == numchapters is the number of ordinals.
+    def chapter_at(self, i):
+        ints = self.ints
+        i = self.order + 5 * i
+        return ints[i], ints[i+1], ints[i+2], ints[i+3], ints[i+4]
+
+    # returns the index of the chapter having given ordinal for `chapter_at`, or -1 if none
+    def find_chapter(self, ordinal):
+        if not 0 <= ordinal < self.numordinals: return -1
+        ints = self.ints
+        lo = 0
+        hi = self.numchapters
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ints[self.order + 5 * mid] <= ordinal:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+# text compression
+#
+# the text and html of `data` rows are stored as blobs deflated with a dictionary of
+# common phrases in each version, kept in the `textdicts` table. zlib in Python 2 has no
+# preset dictionary (`zdict`), so the dictionary is fed as a prefix instead: the compressor
+# and decompressor are primed with it once, and copied for every value. text values
+# (in older databases) are not compressed. verse stores keep texts uncompressed so that
+# they can be sliced as is, hence this only shrinks the database and the SQL fallback.
+
+# deflate can refer back to 32 KB, which should also cover a typical value itself
+TEXTDICT_SIZE = 32000
+PHRASE_PATTERN = re.compile(r'\S+\s*')
+
+# `texts` is a list of UTF-8 strings. the dictionary is made of words and pairs of words
+# which save most when referred, and the best ones come last as they are closest to values.
+def train_text_dictionary(texts, size=TEXTDICT_SIZE):
+    counts = {}
+    for text in texts:
+        words = PHRASE_PATTERN.findall(text)
+        for phrase in words + [a + b for a, b in zip(words, words[1:])]:
+            counts[phrase] = counts.get(phrase, 0) + 1
+    scored = sorted(((count - 1) * len(phrase), phrase)
+                    for phrase, count in counts.iteritems() if count > 1)
+    phrases = []
+    total = 0
+    for _, phrase in reversed(scored):
+        if total + len(phrase) > size: continue
+        phrases.append(phrase)
+        total += len(phrase)
+    return ''.join(reversed(phrases))
+
+class TextCodec(object):
+    def __init__(self, dictionary):
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        primed = self.compressor.compress(dictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.decompressor.decompress(primed)
+
+    def compress(self, text):
+        compressor = self.compressor.copy()
+        return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+        return (decompressor.decompress(bytes(data)) + decompressor.flush()).decode('utf-8')
+
+# returns a dict from versions to codecs, which is empty for older databases
+def load_text_codecs(db):
+    try:
+        rows = db.execute('select version, dictionary from textdicts;').fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return dict((row[0], TextCodec(bytes(row[1]))) for row in rows)
+
+# mappings snapshot
+#
+# bible.py keeps the small tables below in memory (see `Mappings` there). populate.py
+# also stores them as a single marshalled blob in the `snapshot` table, so that they can
+# be loaded without running the queries. the snapshot is only valid for the format and
+# the generation of database (`pragma user_version`) it was written with.
+
+SNAPSHOT_FORMAT = 3
+
+# works with any row factory
+def read_mappings(db, generation):
+    def records(sql):
+        cursor = db.execute(sql)
+        names = [desc[0] for desc in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+    def tuples(sql, args=()):
+        return [tuple(row) for row in db.execute(sql, args)]
+    def optional_tuples(sql): # for tables missing from older databases
+        try:
+            return tuples(sql)
+        except sqlite3.OperationalError:
+            return []
+
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'generation': generation,
+        'books': records('select * from books order by book;'),
+        'bookaliases': tuples('select alias, book, lang from bookaliases;'),
+        'versions': records('select * from versions;'),
+        'versionaliases': tuples('select alias, version from versionaliases;'),
+        # (book, minchapter, maxchapter)
+        'chapterranges': tuples('''select book, min(chapter), max(chapter)
+                                  from verses group by book;'''),
+        # (book, chapter, minverse, maxverse, minindex, maxindex, minordinal, maxordinal)
+        'verseranges': tuples('''select book, chapter, min(verse), max(verse),
+                                       min("index"), max("index"), min(ordinal), max(ordinal)
+                                from verses group by book, chapter;'''),
+        # (code, (book1, chapter1, verse1), (book2, chapter2, verse2))
+        'dailyranges': [(row[0], row[1:4], row[4:7]) for row in tuples('''
+            select code, v1.book, v1.chapter, v1.verse, v2.book, v2.chapter, v2.verse
+            from topics
+                 inner join verses v1 on v1.ordinal = ordinal1
+                 inner join verses v2 on v2.ordinal = ordinal2
+            where kind = ?;''', ('daily',))],
+        # (kind, code, ordinal1, ordinal2) of every reading plan
+        'plans': tuples('''select kind, code, ordinal1, ordinal2 from topics
+                          order by kind, code, ordinal1;'''),
+        # (version, generation of the verse store)
+        'versestores': optional_tuples('select version, generation from versestores;'),
+    }
+
+def write_snapshot(db, generation):
+    data = marshal.dumps(read_mappings(db, generation))
+    db.execute('''create table if not exists snapshot(
+                      format integer not null,
+                      generation integer not null,
+                      data blob not null);''')
+    db.execute('delete from snapshot;')
+    db.execute('insert into snapshot(format,generation,data) values(?,?,?);',
+               (SNAPSHOT_FORMAT, generation, buffer(data)))
+
+# returns the snapshot, or reads the tables again if it is missing or stale
+def load_mappings(db, generation):
+    try:
+        row = db.execute('select data from snapshot where format=? and generation=?;',
+                         (SNAPSHOT_FORMAT, generation)).fetchone()
+    except sqlite3.OperationalError: # no snapshot table
+        row = None
+    if row is not None:
+        return marshal.loads(bytes(row[0]))
+    return read_mappings(db, generation)
@@ -0,0 +1,182 @@
+# coding=utf-8
+# pre-renders pages into static files, which can be served in front of the application:
+#
+# - <out>/Gen/1.html etc. for every chapter, <out>/+/daily/01-01.html etc. for daily readings,
+#   <out>/+/plan/<kind>/<code>.html for other reading plans,
+#   and <out>/index.html, <out>/+/daily/list.html, <out>/+/about.html
+# - the same pages (except for the last three) for other versions at <out>/+v/<v>/...,
+#   where <v> is the normalized `v` parameter (e.g. `kjv` or `kjav,kjv`)
+#
+# pages with other query parameters (e.g. `c` for the cursor) are left to the application.
+# each page is accompanied by precompressed variants (<page>.gz, and <page>.br if the brotli
+# module is available), which can be served directly (e.g. `gzip_static` in nginx).
+# only pages whose inputs have changed since the last export are rendered again, as recorded
+# in <out>/.manifest.json.
+import os
+import sys
+import json
+import hashlib
+import datetime
+import multiprocessing
+import bible
+
+MANIFEST = '.manifest.json'
+# file extensions for precompressed variants
+EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+# two-version combinations to export in addition to every blessed version
+bible.app.config.setdefault('EXPORT_VERSION_PAIRS', [])
+
+# everything in `Mappings` which may affect pages; versions are hashed per page.
+def mappings_hash(mappings):
+    records = lambda rows: sorted(sorted((k, v) for k, v in row.items() if k not in ('hash', 'maxgap'))
+                                  for row in rows)
+    return hashlib.sha1(repr((
+        records(mappings.books),
+        records(mappings.versions.values()),
+        sorted((k, str(v[0]), v[1]) for k, v in mappings.bookaliases.items()
+               if not isinstance(k, int)),
+        sorted((k, str(v)) for k, v in mappings.versionaliases.items()),
+        mappings.chapters.body(),
+        mappings.dailyranges,
+        sorted(mappings.planranges.items()),
+    ))).hexdigest()
+
+# returns a list of normalized `v` parameters to export ('' for the default version)
+def version_specs(mappings, pairs):
+    specs = []
+    for version in sorted(mappings.blessedversions.values(), key=str):
+        specs.append('' if str(version) == mappings.DEFAULT_VER else str(version))
+    for v1, v2 in pairs:
+        v1 = mappings.find_version_by_alias(v1)
+        v2 = mappings.find_version_by_alias(v2)
+        specs.append('%s,%s' % (v1, v2) if v1 != v2 else str(v1))
+    return sorted(set(specs))
+
+# yields (file path, url, version spec, ordinal ranges or None, whether it depends on the date)
+def list_pages(mappings, specs):
+    yield 'index.html', '/', '', None, True
+    yield '+/daily/list.html', '/+/daily/list', '', None, True
+    yield '+/about.html', '/+/about', '', None, False
+    for spec in specs:
+        prefix = '+v/%s/' % spec if spec else ''
+        query = '?v=%s' % spec if spec else ''
+        for book in mappings.books:
+            minchapter, maxchapter = mappings.chapters.chapter_range(book.book) or (1, 0)
+            for chapter in xrange(minchapter, maxchapter + 1):
+                start = bible.triple(book.book, chapter, 0)
+                end = bible.triple(book.book, chapter, '$')
+                # previous and next verses are also displayed
+                yield ('%s%s/%d.html' % (prefix, book.code, chapter),
+                       '/%s/%d%s' % (book.code, chapter, query), spec,
+                       [(start.ordinal - 1, end.ordinal + 1)], False)
+        for index in xrange(len(mappings.dailyranges)):
+            daily = bible.Daily(bible.mappings, index)
+            yield ('%s+/daily/%s.html' % (prefix, daily.code),
+                   '/+/daily/%s%s' % (daily.code, query), spec,
+                   [(s.ordinal, e.ordinal) for s, e in daily.ranges], False)
+        for kind, days in sorted(mappings.planranges.items()):
+            if kind == 'daily': continue
+            for code, ranges in days:
+                yield ('%s+/plan/%s/%s.html' % (prefix, kind, code),
+                       '/+/plan/%s/%s%s' % (kind, code, query), spec, ranges, False)
+
+def page_hash(db, mappings, base, url, spec, ranges, dated):
+    h = hashlib.sha1(base)
+    h.update(url)
+    if dated: h.update(datetime.date.today().isoformat())
+    if ranges is not None:
+        versions = [mappings.find_version_by_alias(v) for v in spec.split(',')] if spec else \
+                   [mappings.versions[mappings.DEFAULT_VER]]
+        for version in versions:
+            found = bible.fetch_version_ranges(db, version, ranges)
+            h.update(repr(sorted((ordinal, (text, meta and bytes(meta), html))
+                                 for ordinal, (text, meta, html) in found.items())))
+    return h.hexdigest()
+
+def write_file(path, data):
+    try: os.makedirs(os.path.dirname(path))
+    except OSError: pass
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+# set for each worker process by `init_worker`
+client = None
+
+def init_worker():
+    global client
+    client = bible.app.test_client()
+
+def render_page((path, url)):
+    response = client.get(url)
+    variants = {}
+    if response.status_code == 200:
+        for encoding in bible.ENCODINGS:
+            variants[encoding] = bible.compress(response.data, encoding, best=True)
+    return path, url, response.status_code, response.data, variants
+
+def main(out='export', processes=None):
+    # workers render each page only once
+    bible.app.config['PAGE_CACHE_SIZE'] = 0
+
+    mappings = bible.mappings
+    manifestpath = os.path.join(out, MANIFEST)
+    try:
+        with open(manifestpath, 'rb') as f: manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    base = hashlib.sha1(bible.CODE_HASH + mappings_hash(mappings)).hexdigest()
+    specs = version_specs(mappings, bible.app.config['EXPORT_VERSION_PAIRS'])
+    print >>sys.stderr, 'exporting versions: %s' % ', '.join(spec or mappings.DEFAULT_VER
+                                                           for spec in specs)
+    hashes = {}
+    pending = []
+    with bible.database() as db:
+        for path, url, spec, ranges, dated in list_pages(mappings, specs):
+            hashes[path] = page_hash(db, mappings, base, url, spec, ranges, dated)
+            if manifest.get(path) != hashes[path] or not os.path.exists(os.path.join(out, path)):
+                pending.append((path, url))
+    print >>sys.stderr, '%d of %d pages to render' % (len(pending), len(hashes))
+
+    # connections should not be shared with forked workers
+    bible.pool.reset(mappings.generation)
+    if processes == 1:
+        init_worker()
+        results = map(render_page, pending)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_worker)
+        results = pool.imap_unordered(render_page, pending, chunksize=16)
+
+    failed = 0
+    for i, (path, url, status, data, variants) in enumerate(results):
+        if status != 200:
+            # the previous file (if any) is kept and retried next time
+            print >>sys.stderr, 'failed to render %s: status %d' % (url, status)
+            failed += 1
+            continue
+        write_file(os.path.join(out, path), data)
+        for encoding, compressed in variants.items():
+            write_file(os.path.join(out, path) + EXTENSIONS[encoding], compressed)
+        manifest[path] = hashes[path]
+        if (i + 1) % 1000 == 0:
+            print >>sys.stderr, 'rendered %d pages' % (i + 1)
+    if processes != 1:
+        pool.close()
+        pool.join()
+
+    for path in sorted(set(manifest) - set(hashes)):
+        print >>sys.stderr, 'removing %s' % path
+        for extension in [''] + EXTENSIONS.values():
+            try: os.remove(os.path.join(out, path) + extension)
+            except OSError: pass
+        del manifest[path]
+    write_file(manifestpath, json.dumps(manifest, indent=0, sort_keys=True))
+    if failed: sys.exit(1)
+
+if __name__ == '__main__':
+    # usage: python export.py [out directory [number of processes]]
+    args = sys.argv[1:3]
+    if len(args) > 1: args[1] = int(args[1])
+    main(*args)
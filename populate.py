@@ -7,11 +7,127 @@ import sys
 import sqlite3
 import bz2
 import glob
+import fnmatch
+import itertools
+import multiprocessing
+import hashlib
+import shutil
+from collections import OrderedDict
+import bibledata
 
 def normalize(s):
     return u''.join(s.split()).upper()
 
-def main(out='db/bible.db'):
+# set for each worker process by `init_worker`
+versionaliases = None
+bookaliases = None
+
+def init_worker(versionaliases_, bookaliases_):
+    global versionaliases, bookaliases
+    versionaliases = versionaliases_
+    bookaliases = bookaliases_
+
+def read_verses(path):
+    return bz2.BZ2File(path, 'rb').read()
+
+# returns a list of (version, (book, chapter, verse), text, meta, html, terms)
+def parse_verses(lines):
+    rows = []
+    for line in lines:
+        line = line.rstrip('\r\n').decode('utf-8')
+        if not line: continue
+        bv, b, c, v, t = line.split('\t')
+        if bv not in versionaliases: continue
+        text, meta = parse_text(versionaliases[normalize(bv)], t)
+        # the pre-rendered HTML is omitted if it is identical to the text itself
+        html = unicode(bibledata.render_htmltext(text, meta))
+        rows.append((versionaliases[normalize(bv)],
+                     (bookaliases[normalize(b)][0], int(c), int(v)),
+                     text, meta, html if html != text else None,
+                     sorted(bibledata.index_terms(text))))
+    return rows
+
+# returns the plain text and (if any) the meta blob (in the span format) for the text with markups
+def parse_text(bv, t):
+    assert not any(u'\ue000' <= c <= u'\ue00f' for c in t)
+
+    # \ue000..\ue001: italic
+    # \ue002..\ue003: emphasis
+    # \ue004..\ue005: strong emphasis
+    # \ue006: placeholder for pending annotation
+    t = t.replace(u'<i>', u'\ue000').replace(u'</i>', u'\ue001')
+    if bv == u'kjav':
+        t = t.replace(u'[', u'\ue002').replace(u']', u'\ue003')
+        t = t.replace(u'{', u'\ue004').replace(u'}', u'\ue005')
+    extra = []
+    t = re.sub(ur'(?:\([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+\))+',
+               lambda s: extra.append(s.group(0)) or u'\ue006', t)
+    style = 0
+    chars = []
+    runs = [] # (start, length, style) for non-normal styles
+    anchors = [] # offsets of annotations
+    for ch in t:
+        if ch == u'\ue000': assert style == 0; style = 1
+        elif ch == u'\ue001': assert style == 1; style = 0
+        elif ch == u'\ue002': assert style == 0; style = 2
+        elif ch == u'\ue003': assert style == 2; style = 0
+        elif ch == u'\ue004': assert style == 0; style = 3
+        elif ch == u'\ue005': assert style == 3; style = 0
+        elif ch == u'\ue006': assert not anchors or anchors[-1] < len(chars); anchors.append(len(chars))
+        else:
+            if style:
+                if runs and runs[-1][2] == style and sum(runs[-1][:2]) == len(chars):
+                    runs[-1] = (runs[-1][0], runs[-1][1] + 1, style)
+                else:
+                    runs.append((len(chars), 1, style))
+            chars.append(ch)
+    text = u''.join(chars)
+
+    assert len(anchors) == len(extra)
+    if runs or anchors:
+        meta = bibledata.encode_meta(runs, zip(anchors, extra))
+    else:
+        meta = None
+    return text, meta
+
+# lines of verses are parsed in chunks of this size
+CHUNK_SIZE = 10000
+
+# any change to these files (or reading plans) requires a full rebuild
+METADATA_PATHS = ['data/versions.json', 'data/books.csv', 'data/daily.json']
+# other reading plans in the same format to data/daily.json. the file name without
+# the extension is the kind of their topics.
+PLAN_PATTERN = 'data/plans/*.json'
+
+def metadata_paths():
+    return METADATA_PATHS + sorted(glob.glob(PLAN_PATTERN))
+
+# file paths are kept as byte strings for file operations, but recorded in the database
+# (and turned into plan kinds) as text, assuming UTF-8 file names
+def path_text(path):
+    return path.decode('utf-8')
+
+# returns the kind of topics for a reading plan, or None if the path is not a plan
+def plan_kind(path):
+    if path == 'data/daily.json': return u'daily'
+    if fnmatch.fnmatch(path, PLAN_PATTERN):
+        return path_text(os.path.splitext(os.path.basename(path))[0])
+    return None
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''): h.update(block)
+    return h.hexdigest()
+
+# `rows` should be parsed rows for a single version, sorted by the ordinal
+def version_hash(rows):
+    h = hashlib.sha1()
+    for _, bcv, text, meta, _, _ in rows:
+        h.update(repr((bcv, text, meta)))
+    return h.hexdigest()
+
+def read_versions():
     versions = []
     versionaliases = {}
     path = 'data/versions.json'
@@ -25,7 +141,9 @@ def main(out='db/bible.db'):
         versionaliases[normalize(line['abbr'])] = line['id']
     for k, v in verdata['aliases'].items():
         versionaliases[normalize(k)] = v
+    return versions, versionaliases
 
+def read_books():
     books = []
     bookaliases = {}
     path = 'data/books.csv'
@@ -43,95 +161,270 @@ def main(out='db/bible.db'):
             bookaliases[normalize(line['title_ko'])] = bookid, 'ko'
             bookaliases[normalize(line['abbr_en'])] = bookid, 'en'
             bookaliases[normalize(line['title_en'])] = bookid, 'en'
+    return books, bookaliases
 
-    bcvs = {}
-    data = []
-    for f in glob.glob('data/verses_*.txt.bz2'):
-        i = 0
-        for line in bz2.BZ2File(f, 'rb'):
-            i += 1
-            if i % 10000 == 0: print >>sys.stderr, 'reading %s: line %d' % (f, i)
-            line = line.rstrip('\r\n').decode('utf-8')
-            if not line: continue
-            bv, b, c, v, t = line.split('\t')
-            if bv not in versionaliases: continue
-            b, _ = bookaliases[normalize(b)]
-            c = int(c)
-            v = int(v)
-            bcvs[b, c, v] = None
-            bv = versionaliases[normalize(bv)]
-            assert not any(u'\ue000' <= c <= u'\ue00f' for c in t)
-
-            # \ue000..\ue001: italic
-            # \ue002..\ue003: emphasis
-            # \ue004..\ue005: strong emphasis
-            # \ue006: placeholder for pending annotation
-            t = t.replace(u'<i>', u'\ue000').replace(u'</i>', u'\ue001')
-            if bv == u'kjav':
-                t = t.replace(u'[', u'\ue002').replace(u']', u'\ue003')
-                t = t.replace(u'{', u'\ue004').replace(u'}', u'\ue005')
-            extra = []
-            t = re.sub(ur'(?:\([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+\))+',
-                       lambda s: extra.append(s.group(0)) or u'\ue006', t)
-            flags = 0
-            text = u''
-            markup = ''
-            for s in t:
-                ch = s[-1]
-                if ch == u'\ue000': assert flags == 0; flags = 1
-                elif ch == u'\ue001': assert flags == 1; flags = 0
-                elif ch == u'\ue002': assert flags == 0; flags = 2
-                elif ch == u'\ue003': assert flags == 2; flags = 0
-                elif ch == u'\ue004': assert flags == 0; flags = 3
-                elif ch == u'\ue005': assert flags == 3; flags = 0
-                elif ch == u'\ue006': assert (flags & 128) == 0; flags |= 128
-                else: text += ch; markup += chr(flags); flags &= 127
-            if flags & 128: markup += chr(flags & 128)
-
-            if markup.strip('\0'):
-                meta = [markup] + [s.encode('utf-8') for s in extra]
-                meta = buffer('\xff'.join(meta))
-            else:
-                assert not extra
-                meta = None
-            data.append((bv, (b, c, v), text, meta))
+# returns a list of (path, rows) where rows are in the format of `parse_verses`
+def parse_files(paths, versionaliases, bookaliases, processes=None):
+    if processes == 1:
+        init_worker(versionaliases, bookaliases)
+        imap = itertools.imap
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                    initargs=(versionaliases, bookaliases))
+        imap = pool.imap
 
-    data.sort()
+    # files are decompressed in parallel, then parsed in chunks of lines in parallel.
+    # `imap` keeps the order of chunks, so the result is same to the sequential parsing.
+    chunks = []
+    for path, content in zip(paths, imap(read_verses, paths)):
+        print >>sys.stderr, 'reading %s' % path
+        lines = content.split('\n')
+        for i in xrange(0, len(lines), CHUNK_SIZE):
+            chunks.append((path, i + CHUNK_SIZE, lines[i:i+CHUNK_SIZE]))
+        del content, lines
 
-    ordinal = 0
-    index = {}
-    minverse = {}
-    maxverse = {}
-    for b, c, v in sorted(bcvs.keys()):
-        idx = index.get(b, 0)
-        bcvs[b, c, v] = idx, ordinal
-        if (b, c) not in minverse or minverse[b, c] > v: minverse[b, c] = v
-        if (b, c) not in maxverse or maxverse[b, c] < v: maxverse[b, c] = v
-        ordinal += 1
-        index[b] = idx + 1
-    verses = sorted((b, c, v, i, o) for (b,c,v), (i,o) in bcvs.items())
-    data = sorted((bv, bcvs[bcv][1], text, meta) for bv, bcv, text, meta in data)
+    files = OrderedDict((path, []) for path in paths)
+    for (path, i, _), rows in zip(chunks, imap(parse_verses, (lines for _, _, lines in chunks))):
+        print >>sys.stderr, 'parsing %s: line %d' % (path, i)
+        files[path].extend(rows)
+    del chunks
+    if processes != 1:
+        pool.close()
+        pool.join()
+    return files.items()
+
+# turns parsed rows into rows of `data` and `searchterms`, along with the maximum gap of
+# ordinals and the content hash per version. `ordinals` maps (book, chapter, verse) to ordinal.
+def build_data(rows, ordinals):
+    rows.sort(key=lambda row: (row[0], ordinals[row[1]]))
+
+    print >>sys.stderr, 'indexing...'
+    postings = {}
+    for bv, bcv, _, _, _, terms in rows:
+        ordinal = ordinals[bcv]
+        for term in terms:
+            postings.setdefault((bv, term), []).append(ordinal)
+    searchterms = [(bv, term, bibledata.pack_ordinals(ords))
+                   for (bv, term), ords in sorted(postings.items())]
+    del postings
 
     # there are some gaps between consecutive verses in particular versions
     # in terms of ordinals. so we fetch MAXGAP more verses for previous or
     # next verses processing.
-    def append_maxgap(row):
-        bv = row[0]
-        ords = [ordinal for ibv, ordinal, _, _ in data if bv == ibv]
-        assert ords == sorted(ords)
-        if ords:
-            maxgap = max(o2-o1 for o1, o2 in zip(ords, ords[1:]))
-        else:
-            maxgap = 0
-        return row + (maxgap,)
-    versions = map(append_maxgap, versions)
+    maxgaps = {}
+    hashes = {}
+    for bv, vrows in itertools.groupby(rows, key=lambda row: row[0]):
+        vrows = list(vrows)
+        ords = [ordinals[row[1]] for row in vrows]
+        maxgaps[bv] = max([o2-o1 for o1, o2 in zip(ords, ords[1:])] or [0])
+        hashes[bv] = version_hash(vrows)
+
+    data = [(bv, ordinals[bcv], text, meta and buffer(meta), html)
+            for bv, bcv, text, meta, html, _ in rows]
+    return data, searchterms, maxgaps, hashes
+
+# returns rows of `searchsuffixes` for rows of `searchterms`
+def build_suffixes(searchterms):
+    return [(bv, suffix, term) for bv, term, _ in searchterms
+                               for suffix in bibledata.term_suffixes(term)]
+
+# returns a copy of `data` (sorted by the version) with text and html compressed, and
+# a list of (version, dictionary) used for that (see `bibledata.TextCodec`)
+def compress_data(data):
+    print >>sys.stderr, 'compressing...'
+    compressed = []
+    textdicts = []
+    for bv, rows in itertools.groupby(data, key=lambda row: row[0]):
+        rows = list(rows)
+        dictionary = bibledata.train_text_dictionary(
+                [(html or text).encode('utf-8') for _, _, text, _, html in rows])
+        textdicts.append((bv, buffer(dictionary)))
+        codec = bibledata.TextCodec(dictionary)
+        for _, ordinal, text, meta, html in rows:
+            compressed.append((bv, ordinal, buffer(codec.compress(text)), meta,
+                               html and buffer(codec.compress(html))))
+    return compressed, textdicts
+
+# every file is written to a temporary path and then renamed into place, so that
+# bible.py never sees a partially written file (see `Mappings` there).
+def write_verse_stores(out, generation, count, data):
+    for version, rows in itertools.groupby(data, key=lambda row: row[0]):
+        path = bibledata.verse_store_path(out, version)
+        print >>sys.stderr, 'writing %s' % path
+        bibledata.write_verse_store(path + '.tmp', generation, count, [row[1:] for row in rows])
+        os.rename(path + '.tmp', path)
+
+def write_chapter_table(out, conn, generation):
+    data = bibledata.read_mappings(conn, generation)
+    path = bibledata.chapter_table_path(out)
+    print >>sys.stderr, 'writing %s' % path
+    with open(path + '.tmp', 'wb') as f:
+        f.write(bibledata.build_chapter_table(generation, data['chapterranges'],
+                                              data['verseranges']))
+    os.rename(path + '.tmp', path)
 
-    path = 'data/daily.json'
+def remove_verse_store(out, version):
+    path = bibledata.verse_store_path(out, version)
+    if os.path.exists(path): os.remove(path)
+
+# the generation is stored in `pragma user_version` and increases with every build
+def read_generation(path):
+    if not os.path.exists(path): return 0
+    conn = sqlite3.connect(path)
+    try:
+        generation, = conn.execute('pragma user_version;').fetchone()
+    finally:
+        conn.close()
+    return generation
+
+def main(out='db/bible.db', processes=None):
+    versions, versionaliases = read_versions()
+    books, bookaliases = read_books()
+    paths = sorted(glob.glob('data/verses_*.txt.bz2'))
+    hashes = dict((path, file_hash(path)) for path in metadata_paths() + paths)
+
+    generation = read_generation(out) + 1
+    tmp = out + '.tmp'
+    if os.path.exists(tmp): os.remove(tmp)
+    try:
+        if os.path.exists(out):
+            updated = update(out, tmp, generation, hashes, paths, versionaliases, bookaliases,
+                             processes)
+            if updated is not None:
+                if updated: os.rename(tmp, out)
+                return
+            print >>sys.stderr, 'rebuilding %s from scratch' % out
+            if os.path.exists(tmp): os.remove(tmp)
+        build(tmp, out, generation, hashes, paths, versions, versionaliases, books, bookaliases,
+              processes)
+        os.rename(tmp, out)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+# updates a copy of an existing database `out` at `tmp` only for changed versions.
+# returns True if updated, False if already up to date and None if impossible.
+def update(out, tmp, generation, hashes, paths, versionaliases, bookaliases, processes=None):
+    conn = sqlite3.connect(out)
+    try:
+        try:
+            recorded = dict((path.encode('utf-8'), (hash, filter(None, versions.split(','))))
+                            for path, hash, versions in
+                            conn.execute('select path, hash, versions from sources;'))
+        except sqlite3.OperationalError:
+            return None # built before sources were recorded
+        try:
+            conn.execute('select 1 from searchsuffixes limit 1;')
+        except sqlite3.OperationalError:
+            return None # built before suffixes were indexed
+        if any(recorded.get(path, (None,))[0] != hashes[path]
+               for path in hashes if path not in paths):
+            return None
+        if any(plan_kind(path) for path in recorded if path not in hashes):
+            return None # removed reading plans
+
+        changed = [path for path in paths if recorded.get(path, (None,))[0] != hashes[path]]
+        removed = [path for path in recorded if path not in hashes]
+        if not changed and not removed:
+            print >>sys.stderr, '%s is up to date' % out
+            return False
+
+        # a version is rebuilt from every file having that version, so we may need to
+        # parse some more files than changed ones.
+        affected = set(version for path in changed + removed if path in recorded
+                               for version in recorded[path][1])
+        parsed = OrderedDict()
+        pending = changed
+        while pending:
+            for path, rows in parse_files(pending, versionaliases, bookaliases, processes):
+                parsed[path] = rows
+                affected.update(row[0] for row in rows)
+            pending = [path for path in paths
+                       if path not in parsed and affected.intersection(recorded[path][1])]
+
+        # new verses would shift every ordinal after them
+        ordinals = dict(((b, c, v), o) for b, c, v, o in
+                        conn.execute('select book, chapter, verse, ordinal from verses;'))
+        rows = [row for rows in parsed.values() for row in rows]
+        if not all(row[1] in ordinals for row in rows): return None
+
+        data, searchterms, maxgaps, vhashes = build_data(rows, ordinals)
+        oldhashes = dict(conn.execute('select version, hash from versions;'))
+        updated = set(version for version in affected if vhashes.get(version) != oldhashes.get(version))
+        print >>sys.stderr, 'updating versions: %s' % ', '.join(sorted(updated))
+    finally:
+        conn.close()
+    compressed, textdicts = compress_data([row for row in data if row[0] in updated])
+
+    # the existing database may be in use, so it is never modified in place
+    shutil.copyfile(out, tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute('pragma user_version = %d;' % generation)
+        conn.execute(TEXTDICTS_SCHEMA)
+        conn.execute(VERSESTORES_SCHEMA)
+        for version in sorted(updated):
+            conn.execute('delete from data where version=?;', (version,))
+            conn.execute('delete from searchterms where version=?;', (version,))
+            conn.execute('delete from searchsuffixes where version=?;', (version,))
+            conn.execute('delete from textdicts where version=?;', (version,))
+            conn.execute('delete from versestores where version=?;', (version,))
+            if version in vhashes:
+                conn.execute('insert into versestores(version,generation) values(?,?);',
+                             (version, generation))
+            conn.execute('update versions set maxgap=?, hash=? where version=?;',
+                         (maxgaps.get(version, 0), vhashes.get(version), version))
+        conn.executemany('insert into data(version,ordinal,"text",meta,html) values(?,?,?,?,?);',
+                         compressed)
+        conn.executemany('insert into textdicts(version,dictionary) values(?,?);', textdicts)
+        searchterms = [row for row in searchterms if row[0] in updated]
+        conn.executemany('insert into searchterms(version,term,ordinals) values(?,?,?);',
+                         searchterms)
+        conn.executemany('insert into searchsuffixes(version,suffix,term) values(?,?,?);',
+                         build_suffixes(searchterms))
+
+        # verses no longer in any version would disappear from `verses` in a full rebuild
+        orphans, = conn.execute('select count(*) from verses '
+                                'where ordinal not in (select ordinal from data);').fetchone()
+        if orphans: return None
+
+        for path in removed:
+            conn.execute('delete from sources where path=?;', (path_text(path),))
+        for path, rows in parsed.items():
+            conn.execute('insert or replace into sources(path,hash,versions) values(?,?,?);',
+                         (path_text(path), hashes[path],
+                          ','.join(sorted(set(row[0] for row in rows)))))
+        bibledata.write_snapshot(conn, generation)
+        write_chapter_table(out, conn, generation)
+        print >>sys.stderr, 'committing...'
+        conn.commit()
+    finally:
+        conn.close()
+
+    write_verse_stores(out, generation, len(ordinals), [row for row in data if row[0] in updated])
+    for version in updated:
+        if version not in vhashes: remove_verse_store(out, version)
+    return True
+
+# also created by `update`, as older databases didn't have it
+TEXTDICTS_SCHEMA = '''
+    create table if not exists textdicts(
+        version text not null primary key references versions(version),
+        dictionary blob not null); -- see bibledata.TextCodec
+'''
+VERSESTORES_SCHEMA = '''
+    create table if not exists versestores(
+        version text not null primary key references versions(version),
+        generation integer not null); -- see bibledata.VerseStore
+'''
+
+# returns topics rows (kind, code, ordinal1, ordinal2) for a reading plan, which maps each
+# code to a flat list of ranges, either `book, chapter1, chapter2` or `book, c1, v1, c2, v2`
+def read_plan(path, kind, bookaliases, bcvs, minverse, maxverse):
     topics = []
     with open(path, 'rb') as f:
         print >>sys.stderr, 'reading %s' % path
-        dailydata = json.load(f)
-    for code, ranges in sorted(dailydata.items()):
+        plandata = json.load(f)
+    for code, ranges in sorted(plandata.items()):
         ordranges = []
         while ranges:
             book, _ = bookaliases[normalize(ranges[0])]
@@ -157,12 +450,58 @@ def main(out='db/bible.db'):
                 ordranges[i] = (ordranges[i][0], ordranges[i+1][1])
                 ordranges[i+1] = None
         for ordinal1, ordinal2 in filter(None, ordranges):
-            topics.append(('daily', code, ordinal1, ordinal2))
+            topics.append((kind, code, ordinal1, ordinal2))
+    return topics
+
+# builds a new database at `tmp`, which is going to be renamed to `out`
+def build(tmp, out, generation, hashes, paths, versions, versionaliases, books, bookaliases,
+          processes=None):
+    files = parse_files(paths, versionaliases, bookaliases, processes)
+    sources = [(path_text(path), hashes[path], ','.join(sorted(set(row[0] for row in rows))))
+               for path, rows in files]
+    sources += [(path_text(path), hashes[path], '')
+                for path in sorted(hashes) if path not in paths]
+
+    bcvs = {}
+    rows = []
+    for _, filerows in files:
+        for row in filerows:
+            bcvs[row[1]] = None
+        rows.extend(filerows)
+    del files
+
+    ordinal = 0
+    index = {}
+    minverse = {}
+    maxverse = {}
+    for b, c, v in sorted(bcvs.keys()):
+        idx = index.get(b, 0)
+        bcvs[b, c, v] = idx, ordinal
+        if (b, c) not in minverse or minverse[b, c] > v: minverse[b, c] = v
+        if (b, c) not in maxverse or maxverse[b, c] < v: maxverse[b, c] = v
+        ordinal += 1
+        index[b] = idx + 1
+    verses = sorted((b, c, v, i, o) for (b,c,v), (i,o) in bcvs.items())
+
+    data, searchterms, maxgaps, vhashes = build_data(rows, dict((bcv, o) for bcv, (_, o) in bcvs.items()))
+    del rows
+    compressed, textdicts = compress_data(data)
+    versions = [row + (maxgaps.get(row[0], 0), vhashes.get(row[0])) for row in versions]
+
+    topics = []
+    kinds = set()
+    for path in sorted(hashes):
+        kind = plan_kind(path)
+        if kind is None: continue
+        assert kind not in kinds, 'duplicate reading plan: %s' % kind
+        kinds.add(kind)
+        topics.extend(read_plan(path, kind, bookaliases, bcvs, minverse, maxverse))
 
     print >>sys.stderr, 'committing...'
     try: os.makedirs(os.path.dirname(out))
     except Exception: pass
-    conn = sqlite3.connect(out)
+    conn = sqlite3.connect(tmp)
+    conn.execute('pragma user_version = %d;' % generation)
     conn.executescript('''
         create table if not exists versions(
             version text not null primary key,
@@ -173,7 +512,8 @@ def main(out='db/bible.db'):
             copyright text,
             title_ko text,
             title_en text,
-            maxgap integer not null);
+            maxgap integer not null,
+            hash text); -- content hash of data in this version, if any
         create table if not exists versionaliases(
             alias text not null,
             version text not null references versions(version),
@@ -202,8 +542,9 @@ def main(out='db/bible.db'):
         create table if not exists data(
             version text not null references versions(version),
             ordinal integer not null references verses(ordinal),
-            "text" text not null,
+            "text" text not null, -- compressed with the dictionary in textdicts if a blob
             meta blob,
+            html text, -- "text" rendered with meta, or null if same as "text"
             primary key (version,ordinal));
         create table if not exists topics(
             kind text not null,
@@ -212,16 +553,49 @@ def main(out='db/bible.db'):
             ordinal2 integer not null references verses(ordinal),
             check (ordinal1 <= ordinal2),
             primary key (kind,code,ordinal1,ordinal2));
+        create table if not exists searchterms(
+            version text not null references versions(version),
+            term text not null,
+            ordinals blob not null, -- packed ordinals of rows containing the term
+            primary key (version,term));
+        create table if not exists searchsuffixes(
+            version text not null references versions(version),
+            suffix text not null, -- every suffix of a word term (see bibledata.term_suffixes)
+            term text not null,
+            primary key (version,suffix,term));
+        create table if not exists sources(
+            path text not null primary key,
+            hash text not null, -- SHA-1 of the file
+            versions text not null); -- comma-separated versions in the file
     ''')
-    conn.executemany('insert into versions(version,abbr,lang,blessed,year,copyright,title_ko,title_en,maxgap) values(?,?,?,?,?,?,?,?,?);', versions)
+    conn.execute(TEXTDICTS_SCHEMA)
+    conn.execute(VERSESTORES_SCHEMA)
+    conn.executemany('insert into versions(version,abbr,lang,blessed,year,copyright,title_ko,title_en,maxgap,hash) values(?,?,?,?,?,?,?,?,?,?);', versions)
     conn.executemany('insert into versionaliases(alias,version) values(?,?);', versionaliases.items())
     conn.executemany('insert into books(book,code,abbr_ko,title_ko,abbr_en,title_en) values(?,?,?,?,?,?);', books)
     conn.executemany('insert into bookaliases(alias,book,lang) values(?,?,?);', [(a,b,l) for a,(b,l) in bookaliases.items()])
     conn.executemany('insert into verses(book,chapter,verse,"index",ordinal) values(?,?,?,?,?);', verses)
-    conn.executemany('insert into data(version,ordinal,"text",meta) values(?,?,?,?);', data)
+    conn.executemany('insert into data(version,ordinal,"text",meta,html) values(?,?,?,?,?);', compressed)
+    conn.executemany('insert into textdicts(version,dictionary) values(?,?);', textdicts)
+    conn.executemany('insert into versestores(version,generation) values(?,?);',
+                     [(version, generation) for version in sorted(vhashes)])
     conn.executemany('insert into topics(kind,code,ordinal1,ordinal2) values(?,?,?,?);', topics)
+    conn.executemany('insert into searchterms(version,term,ordinals) values(?,?,?);', searchterms)
+    conn.executemany('insert into searchsuffixes(version,suffix,term) values(?,?,?);',
+                     build_suffixes(searchterms))
+    conn.executemany('insert into sources(path,hash,versions) values(?,?,?);', sources)
+    bibledata.write_snapshot(conn, generation)
+    write_chapter_table(out, conn, generation)
     conn.commit()
+    conn.close()
+
+    write_verse_stores(out, generation, len(verses), data)
+    for row in versions:
+        if row[0] not in vhashes: remove_verse_store(out, row[0])
 
 if __name__ == '__main__':
-    main(*sys.argv[1:2])
+    # usage: python populate.py [db/bible.db [number of processes]]
+    args = sys.argv[1:3]
+    if len(args) > 1: args[1] = int(args[1])
+    main(*args)
 
@@ -0,0 +1,70 @@
+# coding=utf-8
+# tests for /+/api/verses, run against the fixture database of bench.py.
+#
+# usage: python -m unittest test_api  (set BIBLE_FIXTURE to reuse a fixture directory)
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import bench
+
+fixture = None
+created = False
+client = None
+
+def setUpModule():
+    global fixture, created, client
+    # `python -m unittest` puts the relative cwd into sys.path, which breaks after chdir
+    if bench.ROOT not in sys.path: sys.path.insert(0, bench.ROOT)
+    fixture = os.environ.get('BIBLE_FIXTURE')
+    if fixture: fixture = os.path.abspath(fixture)
+    if not fixture or not os.path.exists(os.path.join(fixture, 'db', 'bible.db')):
+        if not fixture:
+            fixture = tempfile.mkdtemp(prefix='bible-test-')
+            created = True
+            os.rmdir(fixture)
+        bench.make_fixture(fixture)
+    os.chdir(fixture)
+    import bible
+    client = bible.app.test_client()
+
+def tearDownModule():
+    os.chdir(bench.ROOT) # other test modules may run after this
+    if created: shutil.rmtree(fixture)
+
+class ApiVersesTest(unittest.TestCase):
+    def post(self, body):
+        response = client.post('/+/api/verses', data=body, content_type='application/json')
+        return response.status_code, json.loads(response.get_data())
+
+    def test_get(self):
+        response = client.get('/+/api/verses?r=John+3:16&v=kjv')
+        self.assertEqual(response.status_code, 200)
+        result, = json.loads(response.get_data())['results']
+        self.assertEqual(len(result['verses']), 1)
+        self.assertTrue(result['verses'][0]['kjv']['text'])
+
+    def test_post(self):
+        status, data = self.post(json.dumps({'refs': ['John 3:16', 'Gen 99'], 'versions': ['kjv']}))
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data['results']), 2)
+        self.assertIn('error', data['results'][1])
+
+    def test_body_not_an_object(self):
+        for body in ('[]', '"Gen 1"', '3', 'true'):
+            self.assertEqual(self.post(body), (400, {'error': 'invalid request'}), body)
+
+    def test_refs_not_a_list_of_strings(self):
+        for refs in ('Gen 1', {'ref': 'Gen 1'}, [3], ['Gen 1', None], [['Gen 1']]):
+            status, data = self.post(json.dumps({'refs': refs}))
+            self.assertEqual((status, data), (400, {'error': 'invalid request'}), refs)
+
+    def test_versions_not_a_list_of_strings(self):
+        for versions in ('kjv', [1], [None]):
+            status, data = self.post(json.dumps({'refs': ['Gen 1:1'], 'versions': versions}))
+            self.assertEqual((status, data), (400, {'error': 'invalid request'}), versions)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+# coding=utf-8
+# tests for incremental updates of populate.py, search candidates and database reloading,
+# run against copies of the fixture database of bench.py.
+#
+# usage: python -m unittest test_populate  (set BIBLE_FIXTURE to reuse a fixture directory)
+import os
+import re
+import bz2
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from StringIO import StringIO
+import bench
+
+fixture = None
+created = False
+
+def setUpModule():
+    global fixture, created
+    # `python -m unittest` puts the relative cwd into sys.path, which breaks after chdir
+    if bench.ROOT not in sys.path: sys.path.insert(0, bench.ROOT)
+    fixture = os.environ.get('BIBLE_FIXTURE')
+    if fixture: fixture = os.path.abspath(fixture)
+    if not fixture or not os.path.exists(os.path.join(fixture, 'db', 'bible.db')):
+        if not fixture:
+            fixture = tempfile.mkdtemp(prefix='bible-test-')
+            created = True
+            os.rmdir(fixture)
+        bench.make_fixture(fixture)
+    os.chdir(fixture)
+
+def tearDownModule():
+    os.chdir(bench.ROOT) # other test modules may run after this
+    if created: shutil.rmtree(fixture)
+
+# returns a copy of the fixture, which can be freely modified
+def copy_fixture():
+    path = os.path.join(tempfile.mkdtemp(prefix='bible-test-'), 'fixture')
+    shutil.copytree(fixture, path)
+    return path
+
+def run_populate(path):
+    import populate
+    cwd = os.getcwd()
+    stderr = sys.stderr
+    os.chdir(path)
+    sys.stderr = StringIO()
+    try:
+        populate.main('db/bible.db', 1)
+        return sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+        os.chdir(cwd)
+
+# rewrites the fixture verses at `path`, calling `change` for each parsed line
+def change_verses(path, change, extra=()):
+    filename = os.path.join(path, 'data', 'verses_fixture.txt.bz2')
+    lines = [line.rstrip('\r\n').decode('utf-8').split('\t') for line in bz2.BZ2File(filename)]
+    out = bz2.BZ2File(filename, 'wb')
+    for fields in map(change, lines) + list(extra):
+        out.write(u'\t'.join(fields).encode('utf-8') + '\n')
+    out.close()
+
+# appends a word to the first verse of KJV
+def change_kjv(path, word=u'zzqlovex'):
+    changed = []
+    def change(fields):
+        if fields[0] == u'KJV' and not changed:
+            changed.append(fields)
+            fields = fields[:4] + [fields[4] + u' ' + word]
+        return fields
+    change_verses(path, change)
+
+def generation(path):
+    import populate
+    return populate.read_generation(os.path.join(path, 'db', 'bible.db'))
+
+# returns everything stored for each version, as raw bytes
+def version_contents(path):
+    import bibledata
+    db = os.path.join(path, 'db', 'bible.db')
+    conn = sqlite3.connect(db)
+    try:
+        contents = {}
+        for version, in conn.execute('select version from versions;'):
+            content = contents[version] = []
+            for table, key in (('data', 'ordinal'), ('searchterms', 'term'),
+                               ('searchsuffixes', 'suffix, term'), ('textdicts', 'version'),
+                               ('versestores', 'version')):
+                content.append([tuple(str(v) if isinstance(v, buffer) else v for v in row)
+                                for row in conn.execute('select * from %s where version=? '
+                                                        'order by %s;' % (table, key),
+                                                        (version,))])
+            store = bibledata.verse_store_path(db, version)
+            if os.path.exists(store):
+                with open(store, 'rb') as f: content.append(f.read())
+        return contents
+    finally:
+        conn.close()
+
+def store_generations(path):
+    conn = sqlite3.connect(os.path.join(path, 'db', 'bible.db'))
+    try:
+        return dict(conn.execute('select version, generation from versestores;'))
+    finally:
+        conn.close()
+
+class PopulateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = copy_fixture()
+        self.db = os.path.join(self.path, 'db', 'bible.db')
+        self.generation = generation(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+class UpdateTest(PopulateTestCase):
+    def test_update_changed_version_only(self):
+        before = version_contents(self.path)
+        inode = os.stat(self.db).st_ino
+        change_kjv(self.path)
+        log = run_populate(self.path)
+        self.assertIn('updating versions: kjv\n', log)
+        self.assertNotIn('from scratch', log)
+
+        # a new file is renamed into place with the next generation
+        self.assertNotEqual(os.stat(self.db).st_ino, inode)
+        self.assertFalse(os.path.exists(self.db + '.tmp'))
+        self.assertEqual(generation(self.path), self.generation + 1)
+
+        after = version_contents(self.path)
+        self.assertEqual(sorted(after), sorted(before))
+        for version in before:
+            if version == 'kjv':
+                self.assertNotEqual(after[version], before[version])
+            else:
+                self.assertEqual(after[version], before[version], version)
+        self.assertEqual(store_generations(self.path)['kjv'], self.generation + 1)
+
+        conn = sqlite3.connect(self.db)
+        try:
+            self.assertEqual(conn.execute('select term from searchsuffixes '
+                                          'where version=? and suffix=?;',
+                                          ('kjv', 'qlovex')).fetchall(), [(u'zzqlovex',)])
+        finally:
+            conn.close()
+
+    def test_up_to_date(self):
+        inode = os.stat(self.db).st_ino
+        self.assertIn('is up to date', run_populate(self.path))
+        self.assertEqual(os.stat(self.db).st_ino, inode)
+        self.assertEqual(generation(self.path), self.generation)
+
+    def assertRebuilt(self, log):
+        self.assertIn('from scratch', log)
+        self.assertEqual(generation(self.path), self.generation + 1)
+        self.assertEqual(set(store_generations(self.path).values()), set([self.generation + 1]))
+
+    def test_new_verse_rebuilds(self):
+        # new verses would shift every ordinal after them
+        change_verses(self.path, lambda fields: fields,
+                      extra=[(u'KJV', u'창', u'1', u'32', u'A new verse.')])
+        self.assertRebuilt(run_populate(self.path))
+        conn = sqlite3.connect(self.db)
+        try:
+            self.assertEqual(conn.execute('select count(*) from verses '
+                                          'where book=0 and chapter=1 and verse=32;').fetchone(),
+                             (1,))
+        finally:
+            conn.close()
+
+    def test_changed_metadata_rebuilds(self):
+        with open(os.path.join(self.path, 'data', 'versions.json'), 'ab') as f: f.write('\n')
+        self.assertRebuilt(run_populate(self.path))
+
+    def test_missing_suffixes_rebuild(self):
+        # unchanged versions would have no suffixes after an update
+        conn = sqlite3.connect(self.db)
+        try:
+            conn.execute('drop table searchsuffixes;')
+            conn.commit()
+        finally:
+            conn.close()
+        self.assertRebuilt(run_populate(self.path))
+
+class SearchTest(unittest.TestCase):
+    # ordinals of the version where every keyword is found, by scanning all rows
+    def scan(self, db, version, keywords):
+        where = ' and '.join(['expand(version, "text") like ?'] * len(keywords))
+        return [row['ordinal'] for row in
+                db.execute('select ordinal from data where version=? and %s;' % where,
+                           (version,) + tuple(u'%%%s%%' % keyword for keyword in keywords))]
+
+    def check(self, db, version, keywords):
+        import bible
+        expected = self.scan(db, version, keywords)
+        candidates = bible.find_candidate_ordinals(db, version, keywords)
+        self.assertIsNotNone(candidates, keywords)
+        self.assertEqual(sorted(set(candidates) & set(expected)), sorted(expected), keywords)
+        return expected
+
+    def test_latin(self):
+        import bible
+        with bible.database() as db:
+            self.assertTrue(self.check(db, 'kjv', [u'love']))
+            self.assertTrue(self.check(db, 'kjv', [u'ove'])) # also inside words
+            self.assertTrue(self.check(db, 'kjv', [u'LORD', u'righteous']))
+            self.assertTrue(self.check(db, 'kjv', [u'x'])) # single letters are scanned
+            self.assertFalse(self.check(db, 'kjv', [u'zzqlovex']))
+
+    def test_hangul(self):
+        import bible
+        with bible.database() as db:
+            text, = db.execute('select expand(version, "text") from data '
+                               'where version=? order by ordinal limit 1;', ('krv',)).fetchone()
+            word = re.findall(u'[가-힣]+', text)[0]
+            self.assertTrue(self.check(db, 'krv', [word]))
+            self.assertTrue(self.check(db, 'krv', [word[:1]]))
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        import bible
+        self.path = copy_fixture()
+        self.database = bible.app.config['DATABASE']
+
+    def tearDown(self):
+        import bible
+        bible.app.config['DATABASE'] = self.database
+        self.reload()
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def reload(self):
+        import bible
+        bible.start_reload()
+        # held by the reloading thread until it finishes
+        bible.reload_lock.acquire()
+        bible.reload_lock.release()
+
+    def test_rename_switches_generation(self):
+        import bible
+        old = bible.pool.generation
+        bible.app.config['DATABASE'] = os.path.join(self.path, 'db', 'bible.db')
+        bible.pool.reset(old) # only keeps a connection to the copy
+
+        change_kjv(self.path)
+        run_populate(self.path)
+        new = generation(self.path)
+        self.assertEqual(new, old + 1)
+
+        # the connection to the replaced file is lent until the reload is done
+        bible.reload_lock.acquire()
+        try:
+            with bible.database() as db:
+                self.assertEqual(db.generation, old)
+        finally:
+            bible.reload_lock.release()
+
+        self.reload()
+        self.assertEqual(bible.pool.generation, new)
+        self.assertEqual(bible.mappings.generation, new)
+        with bible.database() as db:
+            self.assertEqual(db.generation, new)
+
+if __name__ == '__main__':
+    unittest.main()